@@ -1,17 +1,61 @@
+import array
+import csv
+import io
 import json
+import random
 import re
 import sqlite3
 import sys
+import threading
+import time
 import warnings
+import zlib
 
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from functools import partial
-from itertools import starmap
+from itertools import count, islice, starmap
+from multiprocessing.pool import ThreadPool
 
 try:
     from itertools import ifilter as filter, imap as map
 except ImportError:  # pragma: no cover Python >= 3.0
     pass
 
+try:
+    from Queue import Empty, PriorityQueue
+except ImportError:  # pragma: no cover Python >= 3.0
+    from queue import Empty, PriorityQueue
+
+try:
+    from urllib import pathname2url, urlencode
+except ImportError:  # pragma: no cover Python >= 3.0
+    from urllib.parse import urlencode
+    from urllib.request import pathname2url
+
+try:
+    string_types, text_type, integer_types, unichr = (basestring,), unicode, (int, long), unichr
+except NameError:  # pragma: no cover Python >= 3.0
+    string_types, text_type, integer_types, unichr = (str,), str, (int,), chr
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+
+# Values of a field matching more than this fraction of documents are not selective
+# enough to look up in an index
+UNSELECTIVE = 0.1
+
+# The number of bytes of the database memory mapped by read-only connections
+READONLY_MMAP_SIZE = 1 << 30
+
+try:
+    _INT_TYPECODE = array.array('q').typecode
+except ValueError:  # pragma: no cover Python < 3.3
+    _INT_TYPECODE = 'l'
+
 
 class MalformedQueryException(Exception):
     pass
@@ -20,11 +64,23 @@ class MalformedQueryException(Exception):
 class Connection(object):
     """
     The high-level connection to a sqlite database. Creating a connection accepts
-    the same args and keyword args as the ``sqlite3.connect`` method
+    the same args and keyword args as the ``sqlite3.connect`` method, including
+    ``cached_statements``, the number of prepared statements sqlite3 keeps for reuse,
+    and these keyword args:
+
+    - ``readonly``: open the database read-only, which requires python 3. Collections
+      are never created
+    - ``immutable``: open a read-only database that no process will change, so that
+      sqlite takes no locks and never checks for changes
+    - ``mmap``: the number of bytes of the database to memory map, 1GB by default for
+      read-only connections. Mapped pages are read straight from the OS page cache,
+      which is shared by every process reading the file
     """
 
     def __init__(self, *args, **kwargs):
         self._collections = {}
+        self._reaper = None
+        self.writer = None
         self.connect(*args, **kwargs)
 
     def connect(self, *args, **kwargs):
@@ -32,22 +88,174 @@ class Connection(object):
         Connect to a sqlite database only if no connection exists. Isolation level
         for the connection is automatically set to autocommit
         """
+        immutable = kwargs.pop('immutable', False)
+        self.readonly = kwargs.pop('readonly', False) or immutable
+        mmap = kwargs.pop('mmap', READONLY_MMAP_SIZE if self.readonly else None)
+
+        if self.readonly:
+            args, database = args[1:], args[0] if args else kwargs.pop('database')
+            assert database != ':memory:', 'In-memory databases cannot be read-only'
+            assert sys.version_info[0] >= 3, 'Read-only databases require python 3'
+            params = [('mode', 'ro')] + ([('immutable', 1)] if immutable else [])
+            kwargs['database'] = _database_uri(database, kwargs.get('uri', False), params)
+            kwargs['uri'] = True
+
+        kwargs.setdefault('cached_statements', 128)
+        self._connect_args = (args, kwargs)
         self.db = sqlite3.connect(*args, **kwargs)
         self.db.isolation_level = None
+        self.db.create_function('regexp', 2, _regexp)
+        self.catalog = Catalog(self.db, readonly=self.readonly)
+        self.cached_statements = kwargs['cached_statements']
+        self.statements = StatementStats(self.cached_statements)
+
+        if mmap is not None:
+            self.db.execute("pragma mmap_size = %d" % mmap)
 
     def close(self):
         """
         Terminate the connection to the sqlite database
         """
+        self.stop_reaper()
+        self.stop_writer()
+
         if self.db is not None:
             self.db.close()
 
+    def start_reaper(self, interval=60, batch=1000):
+        """
+        Starts a background thread that removes expired documents, every ``interval``
+        seconds, from the collections of this connection that have a TTL index (see
+        ``Collection.create_index``). Documents are removed in batches of at most
+        ``batch`` rows so that the database is never locked for long. The thread uses
+        its own connection to the database, so this cannot be used with in-memory
+        databases; call ``Collection.expire`` periodically instead
+        """
+        args, kwargs = self._connect_args
+        assert ':memory:' not in args[:1], 'In-memory databases cannot be reaped'
+        assert not self.readonly, 'Read-only databases cannot be reaped'
+
+        self.stop_reaper()
+        self._reaper = _Reaper(self, interval, batch)
+        self._reaper.start()
+
+    def stop_reaper(self):
+        """
+        Stops the background thread started by ``start_reaper``, if any
+        """
+        if self._reaper is not None:
+            self._reaper.stop()
+            self._reaper = None
+
+    def start_writer(self, max_batch=1000, max_delay=0, retries=10, backoff=0.005):
+        """
+        Starts a ``WriteCoordinator`` that performs the inserts, updates and removals of
+        every collection of this connection on its own connection to the database. The
+        writes queued by any number of threads are committed together, in transactions
+        of up to ``max_batch`` writes, waiting up to ``max_delay`` seconds for a batch to
+        fill. While another process holds the database lock, a batch is retried up to
+        ``retries`` times after a random backoff of up to ``backoff`` seconds, doubled
+        on every attempt. Cannot be used with in-memory databases
+        """
+        args, kwargs = self._connect_args
+        assert ':memory:' not in args[:1], 'In-memory databases cannot have a writer'
+        assert not self.readonly, 'Read-only databases cannot have a writer'
+
+        self.stop_writer()
+        self.writer = WriteCoordinator(self, max_batch, max_delay, retries, backoff)
+        self.writer.start()
+
+        for collection in self._collections.values():
+            collection.writer = self.writer
+        return self.writer
+
+    def stop_writer(self):
+        """
+        Stops the ``WriteCoordinator`` started by ``start_writer``, if any, once every
+        queued write has been committed
+        """
+        if self.writer is not None:
+            for collection in self._collections.values():
+                collection.writer = None
+
+            self.writer.stop()
+            self.writer = None
+
+    def backup(self, dest, pages_per_step=100, progress=None, throttle=0):
+        """
+        Copies the database to ``dest``, a path or a ``Connection``, while it remains in
+        use, with the sqlite online backup API. ``pages_per_step`` pages are copied at a
+        time, and the database is only locked while a step runs, sleeping ``throttle``
+        seconds between steps to leave room for other work. If given, ``progress`` is
+        called after each step with the number of pages remaining and the total pages.
+        Requires python 3.7 or later
+        """
+        assert hasattr(self.db, 'backup'), 'Backups require python 3.7 or later'
+
+        def step(status, remaining, total):
+            if progress is not None:
+                progress(remaining, total)
+            if throttle and remaining:
+                time.sleep(throttle)
+
+        target = dest.db if isinstance(dest, Connection) else sqlite3.connect(dest)
+        try:
+            self.db.backup(target, pages=pages_per_step, progress=step)
+        finally:
+            if target is not getattr(dest, 'db', None):
+                target.close()
+
+    def compact(self, max_pages=None, pages_per_step=100, throttle=0):
+        """
+        Returns the free pages of the database to the file system, shrinking the file,
+        and returns the number of pages freed. Up to ``max_pages`` pages, or all of them,
+        are freed with ``pragma incremental_vacuum``, ``pages_per_step`` at a time, each
+        step in a short transaction and ``throttle`` seconds apart. This requires the
+        database to use ``auto_vacuum = incremental``; a database that doesn't is first
+        converted with a full VACUUM, which frees every page but locks the database for
+        as long as it takes
+        """
+        assert not self.readonly, 'Read-only databases cannot be compacted'
+
+        if self.db.execute("pragma auto_vacuum").fetchone()[0] != 2:
+            converted = self.db.execute("pragma freelist_count").fetchone()[0]
+            self.db.execute("pragma auto_vacuum = incremental")
+            self.db.execute("vacuum")
+        else:
+            converted = 0
+
+        freed = 0
+        while max_pages is None or freed < max_pages:
+            free = self.db.execute("pragma freelist_count").fetchone()[0]
+            pages = min(free, pages_per_step, (max_pages or free) - freed)
+            if pages <= 0:
+                break
+
+            if freed and throttle:
+                time.sleep(throttle)
+
+            # sqlite3 steps a statement without result columns only once, which frees a
+            # single page, so each page is freed by its own pragma in one transaction
+            self.db.execute("begin immediate")
+            try:
+                for _ in range(pages):
+                    self.db.execute("pragma incremental_vacuum(1)")
+            except Exception:
+                self.db.execute("rollback")
+                raise
+            self.db.execute("commit")
+            freed += pages
+
+        return converted + freed
+
     def __getitem__(self, name):
         """
         A pymongo-like behavior for dynamically obtaining a collection of documents
         """
         if name not in self._collections:
-            self._collections[name] = Collection(self.db, name)
+            self._collections[name] = Collection(self.db, name, create=not self.readonly,
+                                                 catalog=self.catalog, statements=self.statements)
+            self._collections[name].writer = self.writer
         return self._collections[name]
 
     def __getattr__(self, name):
@@ -62,56 +270,394 @@ class Connection(object):
         self.close()
         return False
 
+    def create_collection(self, name, capped=False, size=None, max=None):
+        """
+        Creates a collection if it does not exist and returns it. A ``capped`` collection
+        holds at most ``max`` documents and/or ``size`` bytes of documents, removing the
+        oldest documents as new ones are inserted
+        """
+        collection = Collection(self.db, name, create=False, catalog=self.catalog,
+                                statements=self.statements)
+        collection.create(capped=capped, size=size, max=max)
+        collection.writer = self.writer
+        self._collections[name] = collection
+        return collection
+
     def drop_collection(self, name):
         """
-        Drops a collection permanently if it exists
+        Drops a collection permanently if it exists, along with the tables of its
+        multikey indexes, its oplog and the table tracking the size of a capped collection
         """
+        self._collections.pop(name, None)
+        for key, spec in self.catalog.indexes(name).items():
+            if spec['type'] == 'multikey':
+                self.db.execute("drop table if exists [%s{%s}]" % (name, key))
+        for side in ('capped', 'oplog'):
+            self.db.execute("drop table if exists [%s.%s]" % (name, side))
+        self.catalog.remove_collection(name)
         self.db.execute("drop table if exists %s" % name)
 
 
+class Catalog(object):
+    """
+    The persistent description of the collections of a database and their indexes,
+    stored in the ``nosqlite_catalog`` table. Each collection entry holds its codec,
+    options and stats, and each index entry its keys, type and options. The catalog is
+    loaded into memory once and reloaded only if the schema of the database changes,
+    so that opening a collection needs no DDL and no ``sqlite_master`` queries. The
+    catalog of a ``readonly`` database without one is built in memory only
+    """
+
+    def __init__(self, db, readonly=False):
+        self.db = db
+        self.readonly = readonly
+        self._collections = None
+        self._indexes = None
+        self._version = None
+
+    def _load(self):
+        """
+        Loads the catalog into memory unless already loaded and the schema of the
+        database has not changed since, first creating it from the existing schema if
+        the database has no catalog
+        """
+        if self._collections is not None and self._schema_version() == self._version:
+            return
+
+        self._collections, self._indexes = {}, {}
+        try:
+            rows = self.db.execute("select type, collection, spec from nosqlite_catalog").fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+            self._bootstrap()
+
+        for type, collection, spec in rows:
+            spec = json.loads(spec)
+            if type == 'collection':
+                self._collections[collection] = spec
+            else:
+                self._indexes.setdefault(collection, {})[','.join(spec['keys'])] = spec
+
+        self._version = self._schema_version()
+
+    def _bootstrap(self):
+        """
+        Creates the catalog, describing the collections and indexes already in the database
+        """
+        if not self.readonly:
+            self.db.execute("""
+                create table if not exists nosqlite_catalog (
+                    name text primary key,
+                    type text not null,
+                    collection text not null,
+                    spec text not null
+                )
+            """)
+
+        rows = self.db.execute("select type, name, tbl_name, sql from sqlite_master").fetchall()
+        tables = set(name for type, name, table, sql in rows if type == 'table')
+
+        for type, name, table, sql in rows:
+            if type == 'table' and re.search(r'\(\s*id integer primary key autoincrement,'
+                                             r'\s*data text not null\s*\)', sql or ''):
+                self.add_collection(name, {
+                    'codec': 'json',
+                    'capped': {'size': None, 'max': None} if '%s.capped' % name in tables else None,
+                    'oplog': {'size': None} if '%s.oplog' % name in tables else None,
+                    'stats': {},
+                })
+            elif type == 'index':
+                match = re.match(r'^idx\.(.*)\{(.*)\}$', name)
+                if match:
+                    collection, key = match.groups()
+                    self.add_index(collection, key.split(','), {
+                        'type': 'value' if table == collection else 'multikey',
+                        'sparse': ' where ' in (sql or '').lower(),
+                        'ttl_seconds': None,
+                    })
+
+    def _schema_version(self):
+        return self.db.execute("pragma schema_version").fetchone()[0]
+
+    def collection(self, name):
+        """
+        Returns the spec of a collection or None if the collection does not exist
+        """
+        self._load()
+        return self._collections.get(name.strip('[]'))
+
+    def indexes(self, collection):
+        """
+        Returns a dict of the specs of the indexes of a collection, by index key
+        """
+        self._load()
+        return self._indexes.get(collection.strip('[]'), {})
+
+    def _write(self, name, type, collection, spec):
+        if self.readonly:
+            return
+
+        self.db.execute(
+            "insert or replace into nosqlite_catalog(name, type, collection, spec) values (?, ?, ?, ?)",
+            (name, type, collection, json.dumps(spec))
+        )
+
+        # Our own writes go with a schema change that need not reload the catalog
+        if self._collections is not None:
+            self._version = self._schema_version()
+
+    def add_collection(self, name, spec):
+        """
+        Records or replaces the spec of a collection
+        """
+        name = name.strip('[]')
+        self._write(name, 'collection', name, spec)
+        if self._collections is not None:
+            self._collections[name] = spec
+
+    def add_index(self, collection, keys, spec):
+        """
+        Records or replaces the spec of an index of a collection on the given keys
+        """
+        collection = collection.strip('[]')
+        spec = dict(spec, keys=list(keys))
+        self._write('idx.%s{%s}' % (collection, ','.join(keys)), 'index', collection, spec)
+        if self._indexes is not None:
+            self._indexes.setdefault(collection, {})[','.join(keys)] = spec
+
+    def remove_index(self, collection, key):
+        """
+        Removes the index of a collection with the given (comma joined) key
+        """
+        collection = collection.strip('[]')
+        self._load()
+        self.db.execute("delete from nosqlite_catalog where name = ?", ('idx.%s{%s}' % (collection, key),))
+        self._indexes.get(collection, {}).pop(key, None)
+
+    def remove_collection(self, name):
+        """
+        Removes a collection and its indexes
+        """
+        name = name.strip('[]')
+        self._load()
+        self.db.execute("delete from nosqlite_catalog where collection = ?", (name,))
+        self._collections.pop(name, None)
+        self._indexes.pop(name, None)
+
+
+class StatementStats(object):
+    """
+    Counts how often the statements run by collections would be found in the statement
+    cache of their sqlite3 connection, by keeping the same least recently used cache of
+    ``size`` SQL strings. Misses are statements that sqlite had to prepare again
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, sql):
+        """
+        Counts a statement as a hit or a miss and marks it as the most recently used
+        """
+        with self._lock:
+            if self._cache.pop(sql, None):
+                self.hits += 1
+            else:
+                self.misses += 1
+                while self._cache and len(self._cache) >= self.size:
+                    self._cache.popitem(last=False)
+
+            if self.size > 0:
+                self._cache[sql] = True
+
+    def reset(self):
+        """
+        Resets the hit and miss counts
+        """
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def __repr__(self):
+        return '<StatementStats size=%d hits=%d misses=%d>' % (self.size, self.hits, self.misses)
+
+
 class Collection(object):
     """
-    A virtual database table that holds JSON-type documents
+    A virtual database table that holds JSON-type documents. Collections opened through
+    a ``Connection`` share its ``Catalog``, which describes the collection and its indexes
+    without querying the schema; without a catalog, the schema is queried as needed.
+    They also count the statements they run in its ``StatementStats``
     """
 
-    def __init__(self, db, name, create=True):
+    def __init__(self, db, name, create=True, catalog=None, statements=None):
         self.db = db
         self.name = name
+        self.catalog = catalog
+        self.statements = statements
+        self.writer = None
+        self.ttl = None
+        self._index_cache = None
+        self._stats = {}
+        self._prepare()
+
+        if catalog is None:
+            self.db.create_function('regexp', 2, _regexp)
+        elif catalog.collection(name) is not None:
+            create = False
+            for key, spec in self._index_specs().items():
+                if spec.get('ttl_seconds') is not None:
+                    self.ttl = (key, spec['ttl_seconds'])
 
         if create:
             self.create()
 
+    def _prepare(self):
+        """
+        Formats the SQL of the most common statements once, rather than on every call,
+        so that each is always the same string for the statement cache
+        """
+        self._sql = {
+            'insert': "insert into %s(data) values (?)" % self.name,
+            'update': "update %s set data = ? where id = ?" % self.name,
+            'remove': "delete from %s where id = ?" % self.name,
+            'clear': "delete from %s" % self.name,
+            'select': "select id, data from %s" % self.name,
+            'last_id': "select coalesce(max(id), 0) from %s" % self.name,
+            'tail': "select id, data from %s where id > ?{where} order by id limit ?" % self.name,
+            'import': """
+                insert into %s(id, data) values (json_extract(?1, '$._id'), json_remove(?1, '$._id'))
+                on conflict(id) do update set data = excluded.data
+            """ % self.name,
+        }
+
+    def _execute(self, sql, *args):
+        """
+        Executes a statement, counting it in the statement cache stats if there are any
+        """
+        if self.statements is not None:
+            self.statements.record(sql)
+        return self.db.execute(sql, *args)
+
+    def _write(self, sql, params):
+        """
+        Executes a statement that writes a document, through the ``WriteCoordinator`` of
+        the connection if it has one. Returns the cursor, or an object with the same
+        ``lastrowid`` and ``rowcount``
+        """
+        if self.writer is not None:
+            return self.writer.submit(sql, params)
+        return self._execute(sql, params)
+
+    def _executemany(self, sql, rows):
+        if self.statements is not None:
+            self.statements.record(sql)
+        return self.db.executemany(sql, rows)
+
     def clear(self):
         """
         Clears all stored documents in this database. THERE IS NO GOING BACK
         """
-        self.db.execute("delete from %s" % self.name)
+        self._execute(self._sql['clear'])
 
     def exists(self):
         """
         Checks if this collection exists
         """
+        if self.catalog is not None:
+            return self.catalog.collection(self.name) is not None
         return self._object_exists('table', self.name)
 
     def _object_exists(self, type, name):
-        row = self.db.execute(
+        row = self._execute(
             "select count(1) from sqlite_master where type = ? and name = ?",
             (type, name.strip('[]'))
         ).fetchone()
 
         return int(row[0]) > 0
 
-    def create(self):
+    def create(self, capped=False, size=None, max=None):
         """
-        Creates the collections database only if it does not already exist
+        Creates the collections database only if it does not already exist. A ``capped``
+        collection holds at most ``max`` documents and/or ``size`` bytes of document data.
+        Documents are stored in insertion order by their autoincrement id, so the oldest
+        are evicted by a trigger with a single delete of the lowest ids
         """
-        self.db.execute("""
+        self._execute("""
             create table if not exists %s (
                 id integer primary key autoincrement,
                 data text not null
             )
         """ % self.name)
 
+        if capped:
+            assert size or max, 'Capped collections require a size or max'
+            self._create_capped(size, max)
+
+        if self.catalog is not None:
+            spec = self.catalog.collection(self.name) or {
+                'codec': 'json',
+                'capped': None,
+                'oplog': None,
+                'stats': {},
+            }
+            if capped:
+                spec = dict(spec, capped={'size': size, 'max': max})
+            self.catalog.add_collection(self.name, spec)
+
+    def _create_capped(self, size, max):
+        """
+        Creates the table that tracks the size of a capped collection, and the triggers
+        that keep it up to date and evict the oldest documents
+        """
+        capped = '[%s.capped]' % self.name
+        self._execute("create table if not exists %s (bytes integer not null)" % capped)
+        self._execute("""
+            insert into {capped}(bytes) select coalesce(sum(length(data)), 0) from {collection}
+            where not exists (select 1 from {capped})
+        """.format(capped=capped, collection=self.name))
+
+        evict = []
+        if max:
+            evict.append(
+                "delete from {collection} where id < "
+                "(select id from {collection} order by id desc limit 1 offset %d);" % (int(max) - 1))
+        if size:
+            # Walk the oldest documents until enough bytes would be freed, then delete
+            # them all with one range delete. The new document itself is never evicted
+            evict.append("""
+                delete from {collection} where id < new.id and id <= (
+                    with recursive oldest(id, freed) as (
+                        select id, length(data) from {collection}
+                        where id = (select min(id) from {collection})
+                        union all
+                        select c.id, oldest.freed + length(c.data) from oldest, {collection} as c
+                        where c.id = (select min(id) from {collection} where id > oldest.id)
+                        and oldest.freed < (select bytes from {capped}) - %(size)d
+                    )
+                    select max(id) from oldest
+                ) and (select bytes from {capped}) > %(size)d;
+            """ % {'size': int(size)})
+
+        triggers = {
+            'insert': "update {capped} set bytes = bytes + length(new.data); %s" % ' '.join(evict),
+            'update of data': "update {capped} set bytes = bytes + length(new.data) - length(old.data);",
+            'delete': "update {capped} set bytes = bytes - length(old.data);",
+        }
+
+        for event, body in triggers.items():
+            name = '[%s.capped.%s]' % (self.name, event.split()[0])
+            self._execute("drop trigger if exists %s" % name)
+            self._execute("create trigger {name} after {event} on {collection} begin {body} end".format(
+                name=name,
+                event=event,
+                collection=self.name,
+                body=body.format(capped=capped, collection=self.name),
+            ))
+
     def insert(self, document):
         """
         Inserts a document into this collection. If a document already has an '_id'
@@ -123,9 +669,7 @@ class Collection(object):
             return self.update(document)
 
         # Create it and return a modified one with the id
-        cursor = self.db.execute("""
-            insert into %s(data) values (?)
-        """ % self.name, (json.dumps(document),))
+        cursor = self._write(self._sql['insert'], (json.dumps(document),))
 
         document['_id'] = cursor.lastrowid
         return document
@@ -142,9 +686,7 @@ class Collection(object):
         copy = document.copy()
         del copy['_id']
 
-        self.db.execute("""
-            update %s set data = ? where id = ?
-        """ % self.name, (json.dumps(copy), document['_id']))
+        self._write(self._sql['update'], (json.dumps(copy), document['_id']))
 
         return document
 
@@ -154,7 +696,7 @@ class Collection(object):
         document does not have an _id attribute
         """
         assert '_id' in document, 'Document must have an id'
-        self.db.execute("delete from %s where id = ?" % self.name, (document['_id'],))
+        self._write(self._sql['remove'], (document['_id'],))
 
     def save(self, document):
         """
@@ -181,17 +723,30 @@ class Collection(object):
 
     def find(self, query=None, limit=None):
         """
-        Returns a list of documents in this collection that match a given query
+        Returns a list of documents in this collection that match a given query. As much
+        of the query as possible is translated to SQL (see ``_compile_query``) so that
+        sqlite can filter rows, and use indexes, before any JSON is decoded. Any part of
+        the query that could not be translated exactly is then applied in python
         """
         results = []
         query = query or {}
+        where, params, exact = self._compile_query(query)
+
+        sql = self._sql['select']
+        if where:
+            sql += " where %s" % where
+        # Rows come in the order of any index sqlite uses, rather than insertion order
+        sql += " order by id"
+        if exact and limit:
+            sql += " limit %d" % limit
+
+        cursor = self._execute(sql, params)
+        documents = starmap(self._load, cursor.fetchall())
 
-        # TODO: When indexes are implemented, we'll need to intelligently hit one of the
-        # index stores so we don't do a full table scan
-        cursor = self.db.execute("select id, data from %s" % self.name)
-        apply = partial(self._apply_query, query)
+        if not exact:
+            documents = filter(partial(self._apply_query, _split_paths(query)), documents)
 
-        for match in filter(apply, starmap(self._load, cursor.fetchall())):
+        for match in documents:
             results.append(match)
 
             # Just return if we already reached the limit
@@ -200,6 +755,52 @@ class Collection(object):
 
         return results
 
+    def find_columns(self, query=None, fields=None, batch=10000):
+        """
+        Returns the values of some (possibly dotted) ``fields`` of the documents matching
+        a query as columns, reading ``batch`` rows at a time. Values are extracted by
+        sqlite, so documents are only decoded if part of the query must be applied in
+        python. Returns a dict mapping each field to a tuple of (values, mask), where the
+        mask is 1 for documents with a null or missing value:
+
+            {'foo': (array('q', [1, 0, 3]), array('B', [0, 1, 0]))}
+
+        A column holds 64 bit integers if all its values are integers, doubles if they
+        are all numbers, with nulls as 0, and objects such as strings otherwise. Columns
+        and masks are NumPy arrays if numpy is installed, and ``array.array`` objects,
+        or lists of objects, otherwise. JSON booleans are given as 1 and 0, and JSON
+        objects and arrays as their JSON text
+        """
+        assert fields, 'Columns require a list of fields'
+        query = query or {}
+        where, params, exact = self._compile_query(query)
+
+        columns = [_field_expr(field) for field in fields]
+        if not exact:
+            columns.extend(['id', 'data'])
+            matches = partial(self._apply_query, _split_paths(query))
+
+        sql = "select %s from %s" % (', '.join(columns), self.name)
+        if where:
+            sql += " where %s" % where
+        sql += " order by id"
+
+        cursor = self._execute(sql, params)
+        builders = [_Column() for field in fields]
+
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                break
+
+            if not exact:
+                rows = [row[:-2] for row in rows if matches(self._load(*row[-2:]))]
+
+            for column, values in zip(builders, zip(*rows)):
+                column.extend(values)
+
+        return dict((field, column.finish()) for field, column in zip(fields, builders))
+
     def _apply_query(self, query, document):
         """
         Applies a query to a document. Returns True if the document meets the criteria of
@@ -207,7 +808,19 @@ class Collection(object):
         and consists of the following logical checks and operators.
 
         Logical: $and, $or, $nor, $not
-        Operators: $eq, $ne, $gt, $gte, $lt, $lte, $mod, $in, $nin, $all
+        Operators: $eq, $ne, $gt, $gte, $lt, $lte, $mod, $in, $nin, $all, $exists,
+                   $regex, $startswith, $size, $elemMatch
+
+        As with mongodb, a field holding an array is equal to a value if any of its
+        elements are, i.e. {'tags': 'foo'} matches {'tags': ['foo', 'bar']}. The $size
+        operator matches arrays by length, and $elemMatch matches arrays with at least
+        one element that satisfies a query of its own:
+
+            {'scores': {'$elemMatch': {'$gte': 80, '$lt': 85}}}
+            {'items': {'$elemMatch': {'sku': 'abc', 'qty': {'$gt': 5}}}}
+
+        The $regex operator accepts an optional sibling $options string of regular
+        expression flags (any of 'imsx'), i.e. {'foo': {'$regex': '^ba', '$options': 'i'}}
 
         If no logical operator is supplied, it assumed that all field checks must pass. For
         example, these are equivalent:
@@ -239,6 +852,10 @@ class Collection(object):
         In the previous example, this will return any document where the 'bar' key is equal
         to 'baz' and either the 'foo' key is an even number between 0 and 10 or is an odd number
         greater than 10.
+
+        Fields of embedded documents are queried with dotted paths, i.e. {'foo.bar': 5}. These
+        may be given pre-split as tuples of keys (see ``_split_paths``), which ``find`` does so
+        that paths are split once per query rather than once per document.
         """
         matches = []  # A list of booleans
         reapply = lambda q: self._apply_query(q, document)
@@ -256,36 +873,49 @@ class Collection(object):
 
             # Invoke a query operator
             elif isinstance(value, dict):
+                section, key = _resolve(document, field)
+
                 for operator, arg in value.items():
-                    if not self._get_operator_fn(operator)(field, arg, document):
+                    if operator == '$options':
+                        continue
+                    if operator == '$elemMatch':
+                        fn = self._elem_match
+                    else:
+                        fn = self._get_operator_fn(operator)
+                    if operator == '$regex':
+                        arg = _regex_pattern(arg, value.get('$options'))
+                    if not fn(key, arg, section):
                         matches.append(False)
                         break
                 else:
                     matches.append(True)
 
             # Standard
-            elif value != document.get(field, None):
-                # check if field contains a dot
-                if '.' in field:
-                    nodes = field.split('.')
-                    document_section = document
-
-                    try:
-                        for path in nodes[:-1]:
-                            document_section = document_section.get(path, None)
-                    except AttributeError:
-                        document_section = None
-
-                    if document_section is None:
-                        matches.append(False)
-                    else:
-                        if value != document_section.get(nodes[-1], None):
-                            matches.append(False)
-                else:
-                    matches.append(False)
+            else:
+                section, key = _resolve(document, field)
+                matches.append(_equals(section.get(key, None), value))
 
         return all(matches)
 
+    def _elem_match(self, field, query, document):
+        """
+        Returns True if the value of a document field is an array with at least one
+        element matching ``query``. The query may either consist of operators applied
+        to each element, or be a query that elements, as documents, must match. If
+        the query is not a dict, a MalformedQueryException is raised
+        """
+        if not isinstance(query, dict):
+            raise MalformedQueryException("'$elemMatch' must be supplied a query")
+
+        candidate = document.get(field, None)
+        if not isinstance(candidate, list):
+            return False
+
+        if _is_operator_query(query):
+            return any(self._apply_query({'element': query}, {'element': e}) for e in candidate)
+
+        return any(isinstance(e, dict) and self._apply_query(query, e) for e in candidate)
+
     def _get_operator_fn(self, op):
         """
         Returns the function in this module that corresponds to an operator string.
@@ -302,6 +932,269 @@ class Collection(object):
         except AttributeError:
             raise MalformedQueryException("Operator '%s' is not currently implemented" % op)
 
+    def _compile_query(self, query, root=None):
+        """
+        Translates a query into a SQL where clause that can be evaluated by sqlite.
+        Returns a tuple of (clause, params, exact). The clause will be None if no
+        part of the query could be translated. A translated clause will always match
+        at least the documents ``_apply_query`` would; ``exact`` is True only when it
+        matches exactly those documents, meaning no filtering in python is required.
+        Unknown operators raise a MalformedQueryException
+
+        If ``root`` is given, it is the alias of a json_each over an array whose
+        elements the query applies to (see ``$elemMatch``)
+        """
+        clauses, params, exact = [], [], True
+
+        for field, value in query.items():
+            if field in ('$and', '$or'):
+                compiled = [self._compile_query(q, root) for q in value]
+                exact = exact and all(c[2] for c in compiled)
+
+                if field == '$and':
+                    compiled = [c for c in compiled if c[0]]
+                elif not all(c[0] for c in compiled):
+                    # A branch we can't translate could match anything
+                    exact = False
+                    continue
+
+                if compiled:
+                    joiner = ' and ' if field == '$and' else ' or '
+                    clauses.append('(%s)' % joiner.join(c[0] for c in compiled))
+                    params.extend(p for c in compiled for p in c[1])
+                elif field == '$or':
+                    # Without branches, nothing matches
+                    clauses.append('0')
+                continue
+
+            if field in ('$nor', '$not'):
+                # Negating a partial translation would exclude real matches
+                exact = False
+                continue
+
+            if not isinstance(value, dict):
+                value = {'$eq': value}
+
+            for operator, arg in value.items():
+                if operator == '$options':
+                    continue
+                if operator != '$elemMatch':
+                    self._get_operator_fn(operator)  # Raises if invalid
+                if operator == '$regex':
+                    arg = _regex_pattern(arg, value.get('$options'))
+                    _compile_regex(arg)  # Raises if invalid
+
+                compiled = self._compile_operator(field, operator, arg, root)
+                if compiled is None:
+                    exact = False
+                    continue
+
+                clauses.append(compiled[0])
+                params.extend(compiled[1])
+                exact = exact and compiled[2]
+
+        return (' and '.join(clauses) or None), params, exact
+
+    def _compile_operator(self, field, operator, value, root=None, use_index=True):
+        """
+        Translates a single query operator for a field to a tuple of (clause, params,
+        exact), or None if the operator cannot be evaluated by sqlite. A field of None
+        refers to the array element being iterated by ``root``. Unless ``use_index`` is
+        True, the clause never uses a regular index of the field
+        """
+        if field is not None and '"' in field:
+            # sqlite JSON paths cannot quote a key containing '"'
+            return None
+
+        path = _field_path(field, root)
+        expr = _field_expr(field, root)
+
+        if operator == '$eq':
+            return self._compile_equals(field, value, root)
+
+        if operator in ('$ne', '$nin'):
+            # Clauses using a regular index may be NULL, so they can't be negated
+            if operator == '$ne':
+                compiled = self._compile_equals(field, value, root, use_index=False)
+            else:
+                compiled = self._compile_operator(field, '$in', value, root, use_index=False)
+
+            # Only an exact clause can be negated without excluding real matches
+            if compiled is None or not compiled[2]:
+                return None
+            return 'not %s' % compiled[0], compiled[1], True
+
+        if operator in ('$gt', '$gte', '$lt', '$lte'):
+            if not _is_scalar(value):
+                return None
+            symbol = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}[operator]
+            clause = '%s %s ?' % (expr, symbol)
+
+            if isinstance(value, string_types):
+                # Numbers sort before text in sqlite, but never compare in python.
+                # JSON objects and arrays are also extracted as text
+                return '%s and %s >= ?' % (clause, expr), [value, ''], False
+
+            if operator in ('$gt', '$gte'):
+                # Text sorts after all numbers, and '' before all other text, so this
+                # keeps the predicate a single index-friendly range over numbers
+                return '%s and %s < ?' % (clause, expr), [value, ''], True
+            return clause, [value], True
+
+        if operator == '$in':
+            if not isinstance(value, (list, tuple)) or not all(map(_is_scalar, value)):
+                return None
+
+            values = [v for v in value if v is not None]
+            clause, params = self._compile_contains(field, 'in (%s)' % ', '.join('?' * len(values)),
+                                                    values, root, use_index)
+            if len(values) < len(value):
+                null, null_params, exact = self._compile_equals(field, None, root)
+                clause, params = '(%s or %s)' % (clause, null), params + null_params
+            return clause, params, not any(map(_looks_like_json, values))
+
+        if operator == '$all':
+            if not isinstance(value, (list, tuple)) or not all(map(_is_scalar, value)):
+                return None
+
+            compiled = [self._compile_equals(field, v, root) for v in value]
+            clause = ' and '.join(c[0] for c in compiled) or '1'
+            return clause, [p for c in compiled for p in c[1]], all(c[2] for c in compiled)
+
+        if operator == '$size':
+            if field == '_id' or not isinstance(value, integer_types) or isinstance(value, bool):
+                return None
+            if not _is_scalar(value):
+                # Beyond 64 bits
+                return None
+            clause = "(json_type(data, %s) = 'array' and json_array_length(data, %s) = ?)"
+            return clause % (path, path), [value], True
+
+        if operator == '$elemMatch':
+            return self._compile_elem_match(field, value, root)
+
+        if operator == '$exists':
+            if field in ('_id', None) or value not in (True, False):
+                return None
+            clause = 'json_type(data, %s) is %snull' % (path, 'not ' if value else '')
+            return clause, [], True
+
+        if operator in ('$regex', '$startswith'):
+            if field == '_id' or not isinstance(value, string_types):
+                return None
+
+            clauses, params = [], []
+            prefix = value if operator == '$startswith' else _regex_prefix(value)
+
+            if prefix:
+                clauses.append('%s >= ?' % expr)
+                params.append(prefix)
+
+                upper = _prefix_upper(prefix)
+                if upper is not None:
+                    clauses.append('%s < ?' % expr)
+                    params.append(upper)
+
+            # Only JSON strings are matched, never the text of objects or arrays
+            clauses.append("json_type(data, %s) = 'text'" % path)
+
+            if operator == '$regex' and value != '^%s' % (prefix or ''):
+                clauses.append('%s regexp ?' % expr)
+                params.append(value)
+
+            return ' and '.join(clauses), params, True
+
+        return None
+
+    def _compile_equals(self, field, value, root=None, use_index=True):
+        """
+        Translates an equality check of a field to a tuple of (clause, params, exact),
+        or None if the value cannot be compared in SQL. Like ``_apply_query``, a field
+        holding an array matches if any of its elements equal the value. Unless
+        ``use_index`` is True, the clause never evaluates to NULL, so that it may be
+        safely negated
+        """
+        if field == '_id' and root is None:
+            return ('id is ?', [value], True) if _is_scalar(value) else None
+
+        path = _field_path(field, root)
+
+        if value is None:
+            clause = ("(json_type(data, {path}) is null or exists (select 1 from "
+                      "json_each(data, {path}) where typeof(key) != 'text' and type = 'null'))")
+            return clause.format(path=path), [], True
+
+        if isinstance(value, list):
+            # Arrays are compared by their JSON text, which is only reliable for strings
+            if not all(isinstance(v, string_types) for v in value):
+                return None
+
+            clause = ("(json_extract(data, {path}) is json(?) or exists (select 1 from "
+                      "json_each(data, {path}) where typeof(key) = 'integer' and "
+                      "type = 'array' and value = json(?)))")
+            return clause.format(path=path), [json.dumps(value)] * 2, True
+
+        if not _is_scalar(value):
+            return None
+
+        clause, params = self._compile_contains(field, '= ?', [value], root, use_index)
+        return clause, params, not _looks_like_json(value)
+
+    def _compile_contains(self, field, predicate, params, root=None, use_index=True):
+        """
+        Returns a tuple of (clause, params) matching documents where either the value of
+        a field, or any of its elements if it is an array, satisfies a SQL predicate.
+        Unless ``use_index`` is True, the clause never evaluates to NULL
+        """
+        if field == '_id' and root is None:
+            return 'id %s' % predicate, params
+
+        kind = self._index_kind(field) if root is None else None
+
+        if kind == 'multikey':
+            # Looking up ids in the index table of a value shared by many documents is
+            # slower than filtering by it, and '+id' stops sqlite from doing so
+            selectivity = self._selectivity(field)
+            clause = '%sid in (select id from [%s{%s}] where value %s)' % (
+                '+' if selectivity is not None and selectivity > UNSELECTIVE else '',
+                self.name, field, predicate)
+            return clause, params
+
+        clause = "exists (select 1 from json_each(data, %s) where typeof(key) != 'text' and value %s)"
+        clause = clause % (_field_path(field, root), predicate)
+
+        if kind == 'value' and use_index:
+            # Arrays are indexed by their JSON text, which sorts from '[' to just before
+            # '\', so the elements of arrays are matched using a second index range
+            expr = _field_expr(field)
+            clause = "(%s %s or (%s >= '[' and %s < '\\' and %s))" % (expr, predicate, expr, expr, clause)
+            return clause, params + params
+
+        return clause, params
+
+    def _compile_elem_match(self, field, query, root=None):
+        """
+        Translates an $elemMatch query to a tuple of (clause, params, exact) using an
+        exists subquery over the elements of an array field
+        """
+        if field == '_id' or not isinstance(query, dict):
+            return None
+
+        alias = 'je%d' % (int(root[2:]) + 1 if root else 0)
+        clauses = ["typeof(%s.key) = 'integer'" % alias]
+
+        if _is_operator_query(query):
+            where, params, exact = self._compile_query({None: query}, alias)
+        else:
+            where, params, exact = self._compile_query(query, alias)
+            clauses.append("%s.type = 'object'" % alias)
+
+        if where:
+            clauses.append(where)
+
+        clause = 'exists (select 1 from json_each(data, %s) as %s where %s)'
+        return clause % (_field_path(field, root), alias, ' and '.join(clauses)), params, exact
+
     def find_one(self, query=None):
         """
         Equivalent to ``find(query, limit=1)[0]``
@@ -329,125 +1222,1318 @@ class Collection(object):
 
     def rename(self, new_name):
         """
-        Rename this collection
+        Rename this collection. Its indexes are named after the collection, so they are
+        dropped and recreated under the new name. So are the triggers of a capped
+        collection or an oplog, whose tables are renamed along with the collection
         """
-        new_collection = Collection(self.db, new_name, create=False)
+        new_collection = Collection(self.db, new_name, create=False, catalog=self.catalog,
+                                    statements=self.statements)
         assert not new_collection.exists()
 
-        self.db.execute("alter table %s rename to %s" % (self.name, new_name))
+        indexes = dict(self._index_specs())
+        for key in indexes:
+            self.drop_index(key)
+
+        # The catalog records which side tables there are, and the options to recreate
+        # their triggers with under the new name
+        if self.catalog is not None:
+            spec = self.catalog.collection(self.name)
+            sides = [side for side in ('capped', 'oplog') if (spec or {}).get(side)]
+            for side in sides:
+                for event in ('insert', 'update', 'delete', 'remove', 'trim'):
+                    self._execute("drop trigger if exists [%s.%s.%s]" % (self.name, side, event))
+        else:
+            sides = [side for side in ('capped', 'oplog')
+                     if self._object_exists('table', '[%s.%s]' % (self.name, side))]
+
+        self._execute("alter table %s rename to %s" % (self.name, new_name))
+        for side in sides:
+            self._execute("alter table [%s.%s] rename to [%s.%s]" % (self.name, side, new_name, side))
+
+        if self.catalog is None:
+            # sqlite rewrites the tables referenced by the trigger bodies, but not their names
+            triggers = self._execute(
+                "select name, sql from sqlite_master where type = 'trigger' and tbl_name in (?, ?)",
+                (new_name, '%s.oplog' % new_name)
+            ).fetchall()
+            for name, sql in triggers:
+                if name.startswith(('%s.capped.' % self.name, '%s.oplog.' % self.name)):
+                    self._execute("drop trigger [%s]" % name)
+                    self._execute(sql.replace('[%s.' % self.name, '[%s.' % new_name, 1))
+        else:
+            self.catalog.remove_collection(self.name)
+            self.catalog.add_collection(new_name, spec)
+
         self.name = new_name
+        self._prepare()
+        self._index_cache = None
+
+        if self.catalog is not None:
+            if 'capped' in sides:
+                self._create_capped(spec['capped']['size'], spec['capped']['max'])
+            if 'oplog' in sides:
+                self.enable_oplog(spec['oplog']['size'])
+        self._restore_indexes(indexes)
 
     def distinct(self, key):
         """
-        Get a set of distinct values for the given key excluding an implicit
-        None for documents that do not contain the key
+        Get a set of distinct values for the given (possibly dotted) key excluding an
+        implicit None for documents that do not contain the key
+        """
+        path = tuple(key.split('.'))
+        sections = [_resolve(d, path) for d in self.find()]
+        return set(s[k] for s, k in sections if k in s)
+
+    def stats(self):
+        """
+        Returns a dict of statistics about this collection: the 'count' of documents,
+        the total 'size' of their JSON, their 'avg_size' and 'max_size' in bytes, and the
+        'pages', 'storage' and 'free' bytes of the table. 'indexes' gives the 'pages',
+        'storage' and 'free' bytes of each index by key. Page usage is read from the
+        dbstat virtual table and is None if sqlite was built without it. 'fields' gives
+        the cardinalities sampled by the last ``analyze``, if any
+        """
+        count, size, avg_size, max_size = self._execute("""
+            select count(1), coalesce(sum(length(data)), 0), coalesce(avg(length(data)), 0),
+                   coalesce(max(length(data)), 0)
+            from %s
+        """ % self.name).fetchone()
+
+        name = self.name.strip('[]')
+        stats = {
+            'count': count,
+            'size': size,
+            'avg_size': avg_size,
+            'max_size': max_size,
+            'indexes': {},
+            'fields': self._field_stats().get('fields', {}),
+        }
+        stats.update(self._page_usage([name]))
+
+        for key, kind in self._indexes().items():
+            names = ['idx.%s{%s}' % (name, key)]
+            if kind == 'multikey':
+                names.append('%s{%s}' % (name, key))
+            stats['indexes'][key] = self._page_usage(names)
+
+        return stats
+
+    def _page_usage(self, names):
+        """
+        Returns a dict of the 'pages', 'storage' and 'free' bytes used by the named
+        tables and indexes
+        """
+        try:
+            pages, storage, free = self._execute("""
+                select count(1), coalesce(sum(pgsize), 0), coalesce(sum(unused), 0)
+                from dbstat where name in (%s)
+            """ % ', '.join('?' * len(names)), names).fetchone()
+        except sqlite3.OperationalError:
+            pages = storage = free = None
+
+        return {'pages': pages, 'storage': storage, 'free': free}
+
+    def analyze(self, sample=1000):
+        """
+        Runs sqlite's ANALYZE over this collection and its indexes, so that sqlite picks
+        the most selective index for a query, and samples the cardinality of every field
+        in up to ``sample`` random documents. Fields in embedded documents are dotted and
+        arrays count their elements. Returns the sampled statistics, which are kept in
+        the catalog, as a dict:
+
+            {'sampled': 1000, 'fields': {'foo': {'count': 800, 'distinct': 12}}}
+
+        where 'count' is the number of sampled documents holding the field and 'distinct'
+        the number of distinct values seen. ``find`` uses these to decide whether looking
+        up a multikey index is worthwhile
+        """
+        self._execute("analyze %s" % self.name)
+        for key, kind in self._indexes().items():
+            if kind == 'multikey':
+                self._execute("analyze [%s{%s}]" % (self.name, key))
+
+        sampled = "select id from %s order by random() limit ?" % self.name
+        rows = self._execute("""
+            select case when typeof(e.key) = 'integer' then e.path else e.fullkey end as field,
+                   count(distinct c.id), count(distinct e.value) + max(e.type = 'null')
+            from {collection} as c, json_tree(c.data) as e
+            where c.id in ({sampled}) and e.type not in ('object', 'array')
+            and field not like '%[%'
+            group by field
+        """.format(collection=self.name, sampled=sampled), (sample,)).fetchall()
+
+        stats = {
+            'sampled': self._execute("select count(1) from (%s)" % sampled, (sample,)).fetchone()[0],
+            'fields': dict((field[2:], {'count': n, 'distinct': distinct}) for field, n, distinct in rows),
+        }
+
+        self._stats = stats
+        self._set_spec(stats=stats)
+        return stats
+
+    def _field_stats(self):
+        """
+        Returns the statistics sampled by ``analyze``, or an empty dict
+        """
+        spec = self.catalog.collection(self.name) if self.catalog is not None else None
+        if spec is not None:
+            return spec.get('stats') or {}
+        return self._stats
+
+    def _selectivity(self, field):
+        """
+        Returns the estimated fraction of documents matching a value of a field, from the
+        sampled statistics, or None if the field has not been sampled
+        """
+        stats = self._field_stats()
+        field = stats.get('fields', {}).get(field)
+        if not field or not field['distinct']:
+            return None
+        return field['count'] / float(stats['sampled'] * field['distinct'])
+
+    def _indexes(self):
+        """
+        Returns a dict of the indexes of this collection, mapping each index key to
+        either 'multikey' or 'value'. Compound index keys are joined by commas
+        """
+        return dict((key, spec['type']) for key, spec in self._index_specs().items())
+
+    def _index_specs(self):
+        """
+        Returns a dict of the specs of the indexes of this collection, by index key. A
+        spec holds the 'keys', the 'type', 'multikey' or 'value', whether the index is
+        'sparse' and its 'ttl_seconds'
         """
-        return set(d[key] for d in filter(lambda d: key in d, self.find()))
+        if self.catalog is not None:
+            return self.catalog.indexes(self.name)
+
+        if self._index_cache is None:
+            name = self.name.strip('[]')
+            rows = self._execute(
+                "select name, tbl_name, sql from sqlite_master where type = 'index'"
+            ).fetchall()
+
+            self._index_cache = {}
+            for index, table, sql in rows:
+                match = re.match(r'^idx\.%s\{(.*)\}$' % re.escape(name), index)
+                if match:
+                    self._index_cache[match.group(1)] = {
+                        'keys': match.group(1).split(','),
+                        'type': 'value' if table == name else 'multikey',
+                        'sparse': ' where ' in (sql or '').lower(),
+                        'ttl_seconds': self.ttl[1] if self.ttl and self.ttl[0] == match.group(1) else None,
+                    }
+
+        return self._index_cache
+
+    def _restore_indexes(self, indexes):
+        """
+        Recreates, and so rebuilds, indexes from their specs as given by ``_index_specs``
+        """
+        for spec in indexes.values():
+            self.create_index(spec['keys'], reindex=False, sparse=spec['sparse'],
+                              multikey=spec['type'] == 'multikey', ttl_seconds=spec['ttl_seconds'])
+
+    def _index_kind(self, field):
+        """
+        Returns the kind of index, 'multikey' or 'value', that covers a field or None
+        """
+        for key, kind in self._indexes().items():
+            if field in key.split(','):
+                return kind
+        return None
 
-    def create_index(self, key, reindex=True, sparse=False):
+    def create_index(self, key, reindex=True, sparse=False, multikey=False, ttl_seconds=None):
         """
-        Creates an index if it does not exist then performs a full reindex for this collection
+        Creates an index if it does not exist, reindexing it if it does. ``key`` is a
+        field or a list of fields for a compound index. Indexes are sqlite expression
+        indexes on the field values, which ``find`` uses for equality and range queries;
+        a ``sparse`` index excludes documents without a value for the first field.
+
+        Queries on indexed fields expect scalar values. Fields holding arrays should use
+        a ``multikey`` index, which stores each element in an index table kept up to date
+        by triggers, so that queries matching array elements can use the index.
+
+        Giving ``ttl_seconds`` makes this a TTL index: the key must hold a unix timestamp,
+        and documents expire ``ttl_seconds`` after it. Expired documents are removed by
+        ``expire``, which ``Connection.start_reaper`` calls in the background
         """
         warnings.warn('Index support is currently very alpha and is not guaranteed')
-        if isinstance(key, (list, tuple)):
-            index_name = ','.join(key)
-            index_columns = ', '.join('%s text' % f for f in key)
+        keys = list(key) if isinstance(key, (list, tuple)) else [key]
+        exists = ','.join(keys) in self._index_specs()
+
+        if ttl_seconds is not None:
+            assert len(keys) == 1 and not multikey, 'TTL indexes must have a single key'
+            self.ttl = (keys[0], ttl_seconds)
+
+        if multikey:
+            assert len(keys) == 1, 'Multikey indexes must have a single key'
+            self._create_multikey_index(keys[0])
         else:
-            index_name = key
-            index_columns = '%s text' % key
+            self._execute("create index if not exists [{index}] on {collection}({columns}){where}".format(
+                index='idx.%s{%s}' % (self.name, ','.join(keys)),
+                collection=self.name,
+                columns=', '.join(map(_field_expr, keys)),
+                where=' where %s is not null' % _field_expr(keys[0]) if sparse else '',
+            ))
+
+        self._index_cache = None
+        if self.catalog is not None:
+            self.catalog.add_index(self.name, keys, {
+                'type': 'multikey' if multikey else 'value',
+                'sparse': sparse,
+                'ttl_seconds': ttl_seconds,
+            })
+
+        if reindex and exists:
+            self.reindex(key)
 
-        table_name = '[%s{%s}]' % (self.name, index_name)
-        reindex = reindex or not self._object_exists('table', table_name)
+    def _create_multikey_index(self, key):
+        """
+        Creates the index table, and the triggers that maintain it, for a multikey index
+        """
+        table = '[%s{%s}]' % (self.name, key)
+        exists = key in self._index_specs()
+        elements = ("select {id}, value from json_each({data}, %s) "
+                    "where typeof(key) != 'text' and type != 'null'" % _json_path(key))
 
-        # Create a table store for the index data
-        self.db.execute("""
+        self._execute("""
             create table if not exists {table} (
-                id integer primary key,
-                {columns},
-                foreign key(id) references {collection}(id) on delete cascade on update cascade
-            )
-        """.format(
-            table=table_name,
-            collection=self.name,
-            columns=index_columns
-        ))
+                id integer not null,
+                value not null,
+                primary key (id, value)
+            ) without rowid
+        """.format(table=table))
 
-        # Create the index
-        self.db.execute("""
-            create index if not exists [idx.{collection}{{index}}] on {table}({index})
-        """.format(
+        self._execute("create index if not exists [idx.{collection}{{{key}}}] on {table}(value)".format(
             collection=self.name,
-            index=index_name,
-            table=table_name,
+            key=key,
+            table=table,
         ))
 
-        if reindex:
-            self.reindex(key)
+        triggers = {
+            'insert': "insert or ignore into {table} %s;" % elements.format(id='new.id', data='new.data'),
+            'update of data': "delete from {table} where id = old.id; insert or ignore into {table} %s;" %
+                              elements.format(id='new.id', data='new.data'),
+            'delete': "delete from {table} where id = old.id;",
+        }
+
+        for event, body in triggers.items():
+            self._execute("""
+                create trigger if not exists [{collection}{{{key}}}.{name}] after {event} on {collection}
+                begin {body} end
+            """.format(
+                collection=self.name,
+                key=key,
+                name=event.split()[0],
+                event=event,
+                body=body.format(table=table),
+            ))
+
+        if not exists:
+            self._populate_multikey_index(key)
+
+    def _populate_multikey_index(self, key):
+        """
+        Fills the index table of a multikey index from the stored documents
+        """
+        self._execute("""
+            insert or ignore into [{collection}{{{key}}}](id, value)
+            select c.id, e.value from {collection} as c, json_each(c.data, {path}) as e
+            where typeof(e.key) != 'text' and e.type != 'null'
+        """.format(collection=self.name, key=key, path=_json_path(key)))
 
-    def ensure_index(self, key, sparse=False):
+    def ensure_index(self, key, sparse=False, multikey=False, ttl_seconds=None):
         """
         Equivalent to ``create_index(key, reindex=False)``
         """
-        self.create_index(key, reindex=False, sparse=False)
+        self.create_index(key, reindex=False, sparse=sparse, multikey=multikey,
+                          ttl_seconds=ttl_seconds)
 
-    def reindex(self, table, sparse=False):
-        warnings.warn('Index support is currently very alpha and is not guaranteed')
-        index = re.findall(r'^\[.*\{(.*)\}\]$', table)[0].split(',')
-        update = "update {table} set {key} = ? where id = ?"
-        insert = "insert into {table}({index}) values({q})"
-        count = "select count(1) from {table} where id = ?"
-        qs = ('?,' * len(index)).rstrip(',')
-
-        for document in self.find():
-            # Ensure there's a row before we update
-            row = self.db.execute(count.format(table=table), (document['_id'],)).fetchone()
-            if int(row[0]) == 0:
-                self.db.execute(insert.format(table=table, index=index, q=qs),
-                                [None for x in index])
-
-            for key in index:
-                # Ignore this document if it doesn't have the key
-                if key not in document and sparse:
-                    continue
+    def expire(self, batch=1000, now=None):
+        """
+        Removes the documents of this collection that have expired according to its TTL
+        index, as of the unix timestamp ``now`` or the current time. Each batch of at most
+        ``batch`` documents is removed with a single statement, using the index to find
+        them. Returns the number of documents removed
+        """
+        assert self.ttl is not None, 'Collection does not have a TTL index'
+        key, ttl_seconds = self.ttl
+        expires = (time.time() if now is None else now) - ttl_seconds
+        removed = 0
+        sql = """
+            delete from {collection} where id in (
+                select id from {collection} where {expr} <= ? limit ?
+            )
+        """.format(collection=self.name, expr=_field_expr(key))
 
-                self.db.execute(update.format(table=table, key=key),
-                                (document.get(key, None), document['_id']))
+        while True:
+            cursor = self._execute(sql, (expires, batch))
 
-    def drop_index(self):
-        warnings.warn('Index support is currently very alpha and is not guaranteed')
-        pass
+            removed += cursor.rowcount
+            if cursor.rowcount < batch:
+                return removed
 
-    def drop_indexes(self):
+    def reindex(self, key=None):
         """
-        Drop all indexes for this collection
+        Rebuilds the index for a key, or every index of this collection if no key is given
         """
         warnings.warn('Index support is currently very alpha and is not guaranteed')
-        pass
+        if key is None:
+            keys = list(self._indexes())
+        else:
+            keys = [','.join(key) if isinstance(key, (list, tuple)) else key]
 
+        for index_key in keys:
+            if self._indexes().get(index_key) == 'multikey':
+                self._execute("delete from [%s{%s}]" % (self.name, index_key))
+                self._populate_multikey_index(index_key)
+            else:
+                self._execute("reindex [idx.%s{%s}]" % (self.name, index_key))
 
-# BELOW ARE OPERATIONS FOR LOOKUPS
-# TypeErrors are caught specifically for python 3 compatibility
-def _eq(field, value, document):
-    """
-    Returns True if the value of a document field is equal to a given value
-    """
-    try:
-        return document.get(field, None) == value
-    except TypeError:  # pragma: no cover Python < 3.0
-        return False
+    def drop_index(self, key):
+        """
+        Drop the index for a key
+        """
+        warnings.warn('Index support is currently very alpha and is not guaranteed')
+        key = ','.join(key) if isinstance(key, (list, tuple)) else key
 
+        if self._indexes().get(key) == 'multikey':
+            for name in ('insert', 'update', 'delete'):
+                self._execute("drop trigger if exists [%s{%s}.%s]" % (self.name, key, name))
+            self._execute("drop table if exists [%s{%s}]" % (self.name, key))
+        else:
+            self._execute("drop index if exists [idx.%s{%s}]" % (self.name, key))
 
-def _gt(field, value, document):
-    """
-    Returns True if the value of a document field is greater than a given value
-    """
-    try:
-        return document.get(field, None) > value
-    except TypeError:  # pragma: no cover Python < 3.0
-        return False
+        if self.ttl is not None and self.ttl[0] == key:
+            self.ttl = None
 
+        self._index_cache = None
+        if self.catalog is not None:
+            self.catalog.remove_index(self.name, key)
 
-def _lt(field, value, document):
+    def drop_indexes(self):
+        """
+        Drop all indexes for this collection
+        """
+        warnings.warn('Index support is currently very alpha and is not guaranteed')
+        for key in list(self._indexes()):
+            self.drop_index(key)
+
+    def enable_oplog(self, size=None):
+        """
+        Starts recording every insert, update and removal of documents in this collection
+        to an oplog table, using triggers, so that changes can be followed with ``watch``.
+        Each change is given a sequence number that is never reused. If ``size`` is given,
+        only that many of the most recent changes are kept
+        """
+        oplog = '[%s.oplog]' % self.name
+        self._execute("""
+            create table if not exists {oplog} (
+                seq integer primary key autoincrement,
+                op text not null,
+                id integer not null,
+                data text
+            )
+        """.format(oplog=oplog))
+
+        for op, event, row in (('insert', 'insert', 'new'),
+                               ('update', 'update of data', 'new'),
+                               ('remove', 'delete', 'old')):
+            self._execute("""
+                create trigger if not exists [{collection}.oplog.{op}] after {event} on {collection}
+                begin insert into {oplog}(op, id, data) values ('{op}', {row}.id, {data}); end
+            """.format(
+                collection=self.name,
+                oplog=oplog,
+                op=op,
+                event=event,
+                row=row,
+                data='null' if row == 'old' else 'new.data',
+            ))
+
+        # The trimming policy may have changed
+        self._execute("drop trigger if exists [%s.oplog.trim]" % self.name)
+        if size is not None:
+            self._execute("""
+                create trigger [{collection}.oplog.trim] after insert on {oplog}
+                begin delete from {oplog} where seq <= new.seq - {size}; end
+            """.format(collection=self.name, oplog=oplog, size=int(size)))
+
+        self._set_spec(oplog={'size': size})
+
+    def disable_oplog(self):
+        """
+        Stops recording changes to this collection and drops its oplog
+        """
+        for op in ('insert', 'update', 'remove', 'trim'):
+            self._execute("drop trigger if exists [%s.oplog.%s]" % (self.name, op))
+        self._execute("drop table if exists [%s.oplog]" % self.name)
+        self._set_spec(oplog=None)
+
+    def _set_spec(self, **options):
+        """
+        Records options of this collection in the catalog, if it has one
+        """
+        if self.catalog is not None and self.catalog.collection(self.name) is not None:
+            self.catalog.add_collection(self.name, dict(self.catalog.collection(self.name), **options))
+
+    def trim_oplog(self, seq):
+        """
+        Removes every change up to and including sequence number ``seq`` from the oplog,
+        i.e. once all consumers have processed them
+        """
+        self._execute("delete from [%s.oplog] where seq <= ?" % self.name, (seq,))
+
+    def watch(self, since=None, interval=1.0, timeout=None, batch=1000):
+        """
+        Returns a generator of the changes made to this collection after sequence number
+        ``since`` or, if not given, from now on. Requires ``enable_oplog``. Each change is a dict:
+
+            {'seq': 12, 'op': 'update', '_id': 3, 'document': {'_id': 3, 'foo': 'bar'}}
+
+        where 'op' is one of 'insert', 'update' or 'remove' and 'document' is None for
+        removals. Changes are read from the oplog in batches of ``batch``, polling every
+        ``interval`` seconds once caught up. If ``timeout`` is given, the generator stops
+        after no changes have been seen for that many seconds
+        """
+        oplog = '[%s.oplog]' % self.name
+        if self.catalog is not None:
+            enabled = (self.catalog.collection(self.name) or {}).get('oplog') is not None
+        else:
+            enabled = self._object_exists('table', oplog)
+        assert enabled, 'Oplog is not enabled'
+
+        if since is None:
+            since = self._execute("select coalesce(max(seq), 0) from %s" % oplog).fetchone()[0]
+
+        rows = self._tail("select seq, op, id, data from %s where seq > ? order by seq limit ?" % oplog,
+                          [], since, interval, timeout, batch)
+
+        return ({
+            'seq': seq,
+            'op': op,
+            '_id': id,
+            'document': None if data is None else self._load(id, data),
+        } for seq, op, id, data in rows)
+
+    def import_jsonl(self, source, batch=10000, defer_indexes=False, progress=None):
+        """
+        Inserts documents from a file, or path to a file, with one JSON document per line.
+        Documents with an '_id' replace any stored document with that id. Documents are
+        passed to sqlite as raw JSON text, without being decoded, and inserted ``batch`` at
+        a time, each batch in its own transaction. See ``_import`` for ``defer_indexes``
+        and ``progress``. Returns the number of documents inserted
+        """
+        with _open(source, 'r') as lines:
+            documents = (line for line in (l.strip() for l in lines) if line)
+            return self._import(documents, batch, defer_indexes, progress)
+
+    def import_csv(self, source, batch=10000, defer_indexes=False, progress=None):
+        """
+        Inserts documents from a CSV file, or path to a CSV file, whose first row names
+        the (possibly dotted) fields of each document. Values are imported as strings,
+        except for an '_id' column. Otherwise, this behaves like ``import_jsonl``
+        """
+        with _open(source, 'r', newline='') as lines:
+            documents = map(_csv_document, _csv_reader(lines))
+            return self._import(documents, batch, defer_indexes, progress)
+
+    def _import(self, documents, batch, defer_indexes, progress):
+        """
+        Inserts an iterable of JSON documents, ``batch`` at a time with ``executemany``,
+        each batch in a transaction. If ``defer_indexes`` is True, the indexes of this
+        collection are dropped for the duration of the import and then rebuilt, which is
+        much faster than updating them for each document. If ``progress`` is given, it is
+        called with the number of documents inserted so far after each batch. Raises a
+        MalformedQueryException, before inserting its batch, for a document that is not
+        a JSON object
+        """
+        count = 0
+
+        deferred = self._drop_indexes_for_import() if defer_indexes else None
+
+        try:
+            while True:
+                chunk = [(document,) for document in islice(documents, batch)]
+                if not chunk:
+                    break
+
+                # sqlite checks that the text is JSON; only an object can start with '{'
+                for document, in chunk:
+                    if not document.startswith('{'):
+                        raise MalformedQueryException('Document is not a JSON object: %r' % document[:50])
+
+                with self._transaction():
+                    self._executemany(self._sql['import'], chunk)
+
+                count += len(chunk)
+                if progress is not None:
+                    progress(count)
+        finally:
+            if deferred is not None:
+                self._restore_indexes(deferred)
+
+        return count
+
+    def _drop_indexes_for_import(self):
+        """
+        Drops the indexes of this collection, returning their specs to restore them
+        with ``_restore_indexes``
+        """
+        indexes = dict(self._index_specs())
+        for key in indexes:
+            self.drop_index(key)
+
+        return indexes
+
+    def export_jsonl(self, dest, query=None, fields=None, batch=10000, progress=None):
+        """
+        Writes the documents matching a query to a file, or path to a file, as one JSON
+        document per line. If ``fields`` is given, only those (possibly dotted) fields,
+        and '_id', are written. Otherwise, the stored JSON text is written as is, without
+        being decoded, when the query can be evaluated entirely by sqlite. Rows are read
+        ``batch`` at a time, calling ``progress`` with the number written so far after
+        each batch. Returns the number of documents written
+        """
+        query = query or {}
+        where, params, exact = self._compile_query(query)
+        raw = exact and fields is None
+
+        def lines(rows):
+            if raw:
+                # Splice the id into the stored JSON text
+                for id, data in rows:
+                    yield '{"_id": %d%s%s\n' % (id, ', ' if data != '{}' else '', data[1:])
+                return
+
+            documents = starmap(self._load, rows)
+            if not exact:
+                documents = filter(partial(self._apply_query, _split_paths(query)), documents)
+
+            for document in documents:
+                if fields is not None:
+                    document = dict([('_id', document['_id'])] + [
+                        (f, s[k]) for f, (s, k) in ((f, _resolve(document, f)) for f in fields) if k in s
+                    ])
+                yield u'%s\n' % json.dumps(document)
+
+        sql = "select id, data from %s%s" % (self.name, ' where %s' % where if where else '')
+
+        with _open(dest, 'w') as output:
+            return self._export(sql, params, lines, output.writelines, batch, progress)
+
+    def export_csv(self, dest, fields, query=None, batch=10000, progress=None):
+        """
+        Writes the (possibly dotted) ``fields`` of the documents matching a query to a CSV
+        file, or path to a CSV file, with a header row of the field names. When the query
+        can be evaluated entirely by sqlite, the field values are extracted by sqlite and
+        documents are never decoded. Embedded documents and arrays are written as JSON.
+        Otherwise, this behaves like ``export_jsonl``
+        """
+        query = query or {}
+        where, params, exact = self._compile_query(query)
+
+        def rows(rows):
+            if exact:
+                return rows
+
+            documents = starmap(self._load, rows)
+            documents = filter(partial(self._apply_query, _split_paths(query)), documents)
+            return ([_csv_value(s.get(k)) for s, k in (_resolve(d, f) for f in fields)]
+                    for d in documents)
+
+        if exact:
+            columns = ', '.join(_csv_expr(f) for f in fields)
+        else:
+            columns = 'id, data'
+
+        sql = "select %s from %s%s" % (columns, self.name, ' where %s' % where if where else '')
+
+        with _open(dest, 'w', newline='') as output:
+            write = _csv_writer(output)
+            write([fields])
+            return self._export(sql, params, rows, write, batch, progress)
+
+    def _export(self, sql, params, transform, write, batch, progress):
+        """
+        Streams the rows of a query through ``transform`` to ``write`` ``batch`` rows at a
+        time, calling ``progress`` with the number of rows written after each batch
+        """
+        cursor = self._execute(sql, params)
+        count = 0
+
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                return count
+
+            output = list(transform(rows))
+            write(output)
+
+            count += len(output)
+            if progress is not None:
+                progress(count)
+
+    @contextmanager
+    def _transaction(self):
+        """
+        A context manager that runs a block in a transaction, committing it if the block
+        succeeds and rolling it back otherwise. If a transaction is already open, the
+        block simply runs as a part of it
+        """
+        if getattr(self.db, 'in_transaction', False):
+            yield
+            return
+
+        # Unless in autocommit mode, the sqlite3 module of python 2 begins a transaction
+        # before each write itself, and does not know of one begun by a statement
+        if sys.version_info[0] < 3 and self.db.isolation_level is not None:  # pragma: no cover
+            commit, rollback = self.db.commit, self.db.rollback
+        else:
+            self._execute('begin')
+            commit, rollback = partial(self._execute, 'commit'), partial(self._execute, 'rollback')
+
+        try:
+            yield
+        except Exception:
+            rollback()
+            raise
+        else:
+            commit()
+
+    def tail(self, query=None, since=None, interval=1.0, timeout=None, batch=1000):
+        """
+        Returns a tailable cursor: a generator of the documents matching a query that are
+        inserted after the document with id ``since`` or, if not given, from now on. This
+        is mostly useful for capped collections. Documents are read in batches of
+        ``batch``, polling every ``interval`` seconds once caught up. If ``timeout`` is
+        given, the generator stops after no documents have been inserted for that many
+        seconds. Updates to documents are not seen; use ``watch`` for those
+        """
+        query = query or {}
+        where, params, exact = self._compile_query(query)
+
+        if since is None:
+            since = self._execute(self._sql['last_id']).fetchone()[0]
+
+        sql = self._sql['tail'].format(where=' and (%s)' % where if where else '')
+        documents = starmap(self._load, self._tail(sql, params, since, interval, timeout, batch))
+
+        if not exact:
+            documents = filter(partial(self._apply_query, _split_paths(query)), documents)
+
+        return documents
+
+    def _tail(self, query, params, since, interval, timeout, batch):
+        """
+        A generator of the rows of a query over an ever growing table, ordered by a
+        sequence in the first column. The query is repeatedly run with the parameters
+        (last sequence seen, *params, ``batch``), sleeping ``interval`` seconds whenever
+        there are no new rows, and stopping once there have been none for ``timeout``
+        seconds
+        """
+        idle_since = time.time()
+
+        while True:
+            rows = self._execute(query, [since] + params + [batch]).fetchall()
+
+            for row in rows:
+                since = row[0]
+                yield row
+
+            if rows:
+                idle_since = time.time()
+                continue
+
+            if timeout is not None and time.time() - idle_since >= timeout:
+                return
+
+            time.sleep(interval)
+
+
+class ShardedConnection(object):
+    """
+    A connection to several sqlite databases, or shards, across which the documents of
+    each collection are partitioned so that writes to different shards do not contend
+    for the same lock. Creating a connection accepts a list of database paths, the
+    ``shard_key`` field that decides the shard of a document and the same keyword args
+    as the ``sqlite3.connect`` method. Documents are placed by a hash of their shard key
+    or, for the default '_id', evenly by id
+    """
+
+    def __init__(self, paths, shard_key='_id', **kwargs):
+        kwargs['check_same_thread'] = False
+        self._collections = {}
+        self.shard_key = shard_key
+        self.shards = [Connection(path, **kwargs) for path in paths]
+        self.locks = [threading.Lock() for shard in self.shards]
+        self.pool = ThreadPool(len(self.shards))
+
+    def close(self):
+        """
+        Terminate the connections to every shard
+        """
+        self.pool.close()
+        for shard in self.shards:
+            shard.close()
+
+    def __getitem__(self, name):
+        """
+        A pymongo-like behavior for dynamically obtaining a collection of documents
+        """
+        if name not in self._collections:
+            self._collections[name] = ShardedCollection(self, name)
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name in self.__dict__:
+            return self.__dict__[name]
+        return self[name]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_traceback):
+        self.close()
+        return False
+
+    def drop_collection(self, name):
+        """
+        Drops a collection permanently from every shard if it exists
+        """
+        self._collections.pop(name, None)
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.drop_collection(name)
+
+
+class ShardedCollection(object):
+    """
+    A collection partitioned across the shards of a ``ShardedConnection``. Writes are
+    routed to the shard owning a document, and queries are run on every shard in
+    parallel, unless they select a single id or shard key value, and their results
+    gathered. Ids are unique across shards: shard i of n assigns ids i + 1, i + 1 + n,
+    and so on. The shard key of a document must hold a scalar value that never changes
+    """
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.shard_key = connection.shard_key
+        self._next_shard = count()
+        self._insert = """
+            insert into {collection}(id, data) values (
+                coalesce((select seq from sqlite_sequence where name = ?), ?) + ?, ?
+            )
+        """.format(collection=name)
+
+        self.collections = []
+        for shard, lock in zip(connection.shards, connection.locks):
+            with lock:
+                self.collections.append(shard[name])
+
+    def _scatter(self, fn, shards=None):
+        """
+        Calls ``fn`` with the collection of each shard, or only of the given shard numbers,
+        in parallel, returning a list of the results
+        """
+        if shards is None:
+            shards = range(len(self.collections))
+
+        def call(i):
+            with self.connection.locks[i]:
+                return fn(self.collections[i])
+
+        if len(shards) == 1:
+            return [call(shards[0])]
+
+        return self.connection.pool.map(call, shards)
+
+    def _shard_of_id(self, id):
+        return (id - 1) % len(self.collections)
+
+    def _shard_of_value(self, value):
+        # crc32 is signed on python 2
+        crc = zlib.crc32(json.dumps(value, sort_keys=True).encode('utf-8')) & 0xffffffff
+        return crc % len(self.collections)
+
+    def _shards_for_query(self, query):
+        """
+        Returns the list of shard numbers that may hold documents matching a query
+        """
+        query = query or {}
+        for field, shard_of in (('_id', self._shard_of_id), (self.shard_key, self._shard_of_value)):
+            # A query that does not mention the field matches any value of it
+            if field not in query:
+                continue
+
+            value = query[field]
+            if isinstance(value, dict) and list(value) == ['$eq']:
+                value = value['$eq']
+
+            if field == '_id':
+                if isinstance(value, int) and not isinstance(value, bool):
+                    return [shard_of(value)]
+            elif _is_scalar(value):
+                return [shard_of(value)]
+
+        return list(range(len(self.collections)))
+
+    def create(self):
+        """
+        Creates the collection on every shard only if it does not already exist
+        """
+        self._scatter(lambda c: c.create())
+
+    def clear(self):
+        """
+        Clears all stored documents from every shard. THERE IS NO GOING BACK
+        """
+        self._scatter(lambda c: c.clear())
+
+    def insert(self, document):
+        """
+        Inserts a document into the shard that owns it. If a document already has an '_id'
+        value it will be updated
+
+        :returns: inserted document with id
+        """
+        if '_id' in document:
+            return self.update(document)
+
+        if self.shard_key == '_id':
+            shard = next(self._next_shard) % len(self.collections)
+        else:
+            shard = self._shard_of_value(document.get(self.shard_key))
+
+        def insert(collection):
+            # Stride ids by the number of shards, starting from the shard number
+            cursor = collection._execute(self._insert, (
+                self.name.strip('[]'),
+                shard + 1 - len(self.collections),
+                len(self.collections),
+                json.dumps(document),
+            ))
+            return cursor.lastrowid
+
+        document['_id'] = self._scatter(insert, [shard])[0]
+        return document
+
+    def update(self, document):
+        """
+        Updates a document stored in the shard that owns it. If the document does not
+        already have an '_id' value, it will be created
+        """
+        if '_id' not in document:
+            return self.insert(document)
+
+        return self._scatter(lambda c: c.update(document), [self._shard_of_id(document['_id'])])[0]
+
+    def remove(self, document):
+        """
+        Removes a document from the shard that owns it. This will raise AssertionError if
+        the document does not have an _id attribute
+        """
+        assert '_id' in document, 'Document must have an id'
+        self._scatter(lambda c: c.remove(document), [self._shard_of_id(document['_id'])])
+
+    def save(self, document):
+        """
+        Alias for ``update``
+        """
+        return self.update(document)
+
+    def delete(self, document):
+        """
+        Alias for ``remove``
+        """
+        return self.remove(document)
+
+    def find(self, query=None, limit=None):
+        """
+        Returns a list of documents, ordered by id, that match a given query on any shard
+        """
+        shards = self._shards_for_query(query)
+        results = self._scatter(lambda c: c.find(query, limit), shards)
+        documents = sorted((d for r in results for d in r), key=lambda d: d['_id'])
+        return documents[:limit] if limit else documents
+
+    def find_one(self, query=None):
+        """
+        Equivalent to ``find(query, limit=1)[0]``
+        """
+        try:
+            return self.find(query=query, limit=1)[0]
+        except (sqlite3.OperationalError, IndexError):
+            return None
+
+    def find_and_modify(self, query=None, update=None):
+        """
+        Finds documents that match a given query on any shard and updates them
+        """
+        self._scatter(lambda c: c.find_and_modify(query, update), self._shards_for_query(query))
+
+    def count(self, query=None):
+        """
+        Returns the number of documents that match a given query on any shard
+        """
+        return sum(self._scatter(lambda c: c.count(query), self._shards_for_query(query)))
+
+    def distinct(self, key):
+        """
+        Get a set of distinct values for the given key across every shard
+        """
+        return set().union(*self._scatter(lambda c: c.distinct(key)))
+
+    def create_index(self, *args, **kwargs):
+        """
+        Equivalent to ``Collection.create_index`` on every shard
+        """
+        self._scatter(lambda c: c.create_index(*args, **kwargs))
+
+    def ensure_index(self, *args, **kwargs):
+        """
+        Equivalent to ``Collection.ensure_index`` on every shard
+        """
+        self._scatter(lambda c: c.ensure_index(*args, **kwargs))
+
+    def drop_index(self, key):
+        """
+        Drop the index for a key on every shard
+        """
+        self._scatter(lambda c: c.drop_index(key))
+
+    def drop_indexes(self):
+        """
+        Drop all indexes for this collection on every shard
+        """
+        self._scatter(lambda c: c.drop_indexes())
+
+
+class _Reaper(threading.Thread):
+    """
+    A daemon thread that periodically expires documents from the collections of a
+    connection that have a TTL index, using its own connection to the database
+    """
+
+    def __init__(self, connection, interval, batch):
+        super(_Reaper, self).__init__()
+        self.daemon = True
+        self.connection = connection
+        self.interval = interval
+        self.batch = batch
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        args, kwargs = self.connection._connect_args
+        db = sqlite3.connect(*args, **kwargs)
+        db.isolation_level = None
+
+        try:
+            while not self._stopped.wait(self.interval):
+                self.reap(db)
+        finally:
+            db.close()
+
+    def reap(self, db):
+        for collection in list(self.connection._collections.values()):
+            if collection.ttl is None:
+                continue
+
+            expiring = Collection(db, collection.name, create=False)
+            expiring.ttl = collection.ttl
+
+            try:
+                expiring.expire(self.batch)
+            except sqlite3.OperationalError:
+                # i.e. the database is locked; try again on the next pass
+                pass
+
+
+class WriteCoordinator(threading.Thread):
+    """
+    A daemon thread that performs the writes of the collections of a connection on its
+    own connection to the database. Writes queued by any number of threads are taken in
+    order of priority and committed together in a single transaction, so the database
+    is locked, and synced to disk, once per batch rather than once per write. Each
+    write runs in a savepoint, so a failing write fails alone.
+
+    When another process holds the database lock, the batch is retried after a random
+    delay, so that contending processes don't retry in lockstep. ``metrics`` reports
+    the depth of the queue and the latency of commits
+    """
+
+    def __init__(self, connection, max_batch=1000, max_delay=0, retries=10, backoff=0.005):
+        super(WriteCoordinator, self).__init__()
+        self.daemon = True
+        self.connection = connection
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = PriorityQueue()
+        self.commits = 0
+        self.writes = 0
+        self.busy_retries = 0
+        self.latencies = deque(maxlen=1000)
+        self._sequence = count()
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        # Held to queue a write, and to check that nothing is queued before exiting
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def priority(self, priority):
+        """
+        Gives the writes made by the current thread inside this context a priority.
+        Writes of a higher priority are committed first; the default is 0
+        """
+        previous = getattr(self._local, 'priority', 0)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def submit(self, sql, params):
+        """
+        Queues a write and waits until it is committed, returning it with the
+        ``lastrowid`` and ``rowcount`` of its statement, or raising its error. Raises
+        ``sqlite3.ProgrammingError`` once the writer has been stopped
+        """
+        write = _Write(sql, params)
+        priority = getattr(self._local, 'priority', 0)
+        with self._lock:
+            if self._stopped.is_set():
+                raise sqlite3.ProgrammingError('Cannot write through a stopped writer')
+            self.queue.put((-priority, next(self._sequence), write))
+
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write
+
+    def metrics(self):
+        """
+        Returns a dict with the current 'queue_depth', the counts of 'commits', 'writes'
+        and 'busy_retries' so far, and the average and maximum 'commit_latency' in
+        seconds, from beginning to committing a batch, over the last 1000 commits
+        """
+        latencies = list(self.latencies)
+        return {
+            'queue_depth': self.queue.qsize(),
+            'commits': self.commits,
+            'writes': self.writes,
+            'busy_retries': self.busy_retries,
+            'commit_latency': {
+                'avg': sum(latencies) / len(latencies) if latencies else None,
+                'max': max(latencies) if latencies else None,
+            },
+        }
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        args, kwargs = self.connection._connect_args
+        # Waiting for locks is done by the backoff instead of the sqlite busy handler
+        db = sqlite3.connect(*args, **dict(kwargs, timeout=0))
+        db.isolation_level = None
+
+        try:
+            while True:
+                with self._lock:
+                    if self._stopped.is_set() and self.queue.empty():
+                        break
+                batch = self._next_batch()
+                if batch:
+                    self._commit(db, batch)
+        finally:
+            db.close()
+
+    def _next_batch(self):
+        """
+        Takes the next batch of writes off the queue, in order of priority
+        """
+        try:
+            batch = [self.queue.get(timeout=0.1)[2]]
+        except Empty:
+            return []
+
+        deadline = time.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                timeout = deadline - time.time()
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except Empty:
+                break
+            batch.append(item[2])
+
+        return batch
+
+    def _commit(self, db, batch):
+        """
+        Performs a batch of writes in a single transaction, retrying with a jittered
+        exponential backoff while the database is locked
+        """
+        started = time.time()
+
+        for attempt in count():
+            try:
+                db.execute("begin immediate")
+                try:
+                    for write in batch:
+                        self._apply(db, write)
+                    db.execute("commit")
+                except Exception:
+                    db.execute("rollback")
+                    raise
+                committed = True
+                break
+            except Exception as e:
+                busy = isinstance(e, sqlite3.OperationalError) and _is_busy(e)
+                if not busy or attempt >= self.retries:
+                    for write in batch:
+                        write.error = e
+                    committed = False
+                    break
+
+                self.busy_retries += 1
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+        # Batches that failed as a whole are not commits
+        if committed:
+            self.commits += 1
+            self.writes += len(batch)
+            self.latencies.append(time.time() - started)
+
+        for write in batch:
+            write.done.set()
+
+    def _apply(self, db, write):
+        """
+        Runs a single write in a savepoint, recording its error, unless the database is
+        locked, without failing the rest of the batch
+        """
+        write.error = None
+        db.execute("savepoint write")
+
+        try:
+            cursor = db.execute(write.sql, write.params)
+        except sqlite3.Error as e:
+            if isinstance(e, sqlite3.OperationalError) and _is_busy(e):
+                raise
+            write.error = e
+            db.execute("rollback to write")
+        else:
+            write.lastrowid, write.rowcount = cursor.lastrowid, cursor.rowcount
+
+        db.execute("release write")
+
+
+class _Write(object):
+    """
+    A write queued on a ``WriteCoordinator``, and its result once committed
+    """
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.lastrowid = None
+        self.rowcount = -1
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Column(object):
+    """
+    Accumulates the values of a column, in batches, into the narrowest of an integer
+    array, a double array or a list of objects, along with a null mask
+    """
+
+    kinds = ('int', 'float', 'object')
+
+    def __init__(self):
+        self.kind = 'int'
+        self.values = array.array(_INT_TYPECODE)
+        self.mask = array.array('B')
+        # The values of a float column as given, in case it is widened to objects
+        self.raw = None
+
+    def extend(self, values):
+        kind = self.kind
+        for value in values:
+            if value is None or isinstance(value, integer_types):
+                continue
+            if isinstance(value, float):
+                kind = max(kind, 'float', key=self.kinds.index)
+            else:
+                kind = 'object'
+                break
+
+        if kind == 'object' and self.kind != 'object':
+            # Objects keep the values collected so far as they were, whatever the batch
+            previous = self.raw if self.kind == 'float' else self.values
+            self.values = [None if null else value for value, null in zip(previous, self.mask)]
+            self.raw = None
+        elif kind == 'float' and self.kind == 'int':
+            self.raw = list(self.values)
+            self.values = array.array('d', self.values)
+        self.kind = kind
+
+        if self.raw is not None:
+            self.raw.extend(values)
+        self.mask.extend(value is None for value in values)
+        null = None if self.kind == 'object' else 0
+        self.values.extend(null if value is None else value for value in values)
+
+    def finish(self):
+        """
+        Returns the tuple of (values, mask), as NumPy arrays if numpy is installed
+        """
+        if numpy is None:
+            return self.values, self.mask
+
+        if self.kind == 'object':
+            values = numpy.empty(len(self.values), dtype=object)
+            values[:] = self.values
+        else:
+            kind = 'i' if self.kind == 'int' else 'f'
+            values = numpy.frombuffer(self.values, dtype='%s%d' % (kind, self.values.itemsize))
+
+        return values, numpy.frombuffer(self.mask, dtype=numpy.uint8).astype(bool)
+
+
+# BELOW ARE OPERATIONS FOR LOOKUPS
+# TypeErrors are caught specifically for python 3 compatibility
+def _eq(field, value, document):
+    """
+    Returns True if the value of a document field is equal to a given value, or is
+    an array containing the value
+    """
+    try:
+        return _equals(document.get(field, None), value)
+    except TypeError:  # pragma: no cover Python < 3.0
+        return False
+
+
+def _gt(field, value, document):
+    """
+    Returns True if the value of a document field is greater than a given value
+    """
+    try:
+        return document.get(field, None) > value
+    except TypeError:  # pragma: no cover Python < 3.0
+        return False
+
+
+def _lt(field, value, document):
     """
     Returns True if the value of a document field is less than a given value
     """
@@ -483,53 +2569,57 @@ def _all(field, value, document):
     """
     Returns True if the value of document field contains all the values
     specified by ``value``. If supplied value is not an iterable, a
-    MalformedQueryException is raised. If the value of the document field
-    is not an iterable, False is returned
+    MalformedQueryException is raised. A document field that is not an
+    iterable only contains itself
     """
     try:
-        a = set(value)
+        values = list(value)
     except TypeError:
         raise MalformedQueryException("'$all' must accept an iterable")
 
-    try:
-        b = set(document.get(field, []))
-    except TypeError:
-        return False
-    else:
-        return a.intersection(b) == a
+    candidate = document.get(field, [])
+    if isinstance(candidate, string_types + (dict,)) or not hasattr(candidate, '__iter__'):
+        candidate = [candidate]
+
+    return all(v in candidate for v in values)
 
 
 def _in(field, value, document):
     """
-    Returns True if document[field] is in the interable value. If the
-    supplied value is not an iterable, then a MalformedQueryException is raised
+    Returns True if document[field] is in the interable value, or is an array
+    containing any of its items. If the supplied value is not an iterable, then
+    a MalformedQueryException is raised
     """
     try:
         values = iter(value)
     except TypeError:
         raise MalformedQueryException("'$in' must accept an iterable")
 
-    return document.get(field, None) in values
+    candidate = document.get(field, None)
+    return any(_equals(candidate, v) for v in values)
 
 
 def _ne(field, value, document):
     """
     Returns True if the value of document[field] is not equal to a given value
+    and is not an array containing it
     """
-    return document.get(field, None) != value
+    return not _equals(document.get(field, None), value)
 
 
 def _nin(field, value, document):
     """
-    Returns True if document[field] is NOT in the interable value. If the
-    supplied value is not an iterable, then a MalformedQueryException is raised
+    Returns True if document[field] is NOT in the interable value, nor is an array
+    containing any of its items. If the supplied value is not an iterable, then a
+    MalformedQueryException is raised
     """
     try:
         values = iter(value)
     except TypeError:
         raise MalformedQueryException("'$nin' must accept an iterable")
 
-    return document.get(field, None) not in values
+    candidate = document.get(field, None)
+    return not any(_equals(candidate, v) for v in values)
 
 
 def _mod(field, value, document):
@@ -567,3 +2657,358 @@ def _exists(field, value, document):
         return field in document
     else:
         return field not in document
+
+
+def _regex(field, value, document):
+    """
+    Returns True if the value of a document field is a string that matches the
+    regular expression ``value``. If the regular expression is invalid, a
+    MalformedQueryException is raised
+    """
+    candidate = document.get(field, None)
+
+    if not isinstance(candidate, string_types):
+        return False
+
+    return _compile_regex(value).search(candidate) is not None
+
+
+def _startswith(field, value, document):
+    """
+    Returns True if the value of a document field is a string that starts with the
+    string ``value``. If the value is not a string, a MalformedQueryException is raised
+    """
+    if not isinstance(value, string_types):
+        raise MalformedQueryException("'$startswith' must be supplied a string")
+
+    candidate = document.get(field, None)
+    return isinstance(candidate, string_types) and candidate.startswith(value)
+
+
+def _size(field, value, document):
+    """
+    Returns True if the value of a document field is an array with ``value`` elements.
+    If the value is not an integer, a MalformedQueryException is raised
+    """
+    if not isinstance(value, integer_types) or isinstance(value, bool):
+        raise MalformedQueryException("'$size' must be supplied an integer")
+
+    candidate = document.get(field, None)
+    return isinstance(candidate, list) and len(candidate) == value
+
+
+def _equals(candidate, value):
+    """
+    Returns True if a document value is equal to a given value or is an array that
+    contains the value
+    """
+    return candidate == value or (isinstance(candidate, list) and value in candidate)
+
+
+def _resolve(document, field):
+    """
+    Returns a tuple of (document, key) for a field, where a dotted field, or a tuple
+    of keys, resolves to the embedded document holding its last key. If an embedded
+    document does not exist, an empty one is returned
+    """
+    if not isinstance(field, tuple):
+        if '.' not in field:
+            return document, field
+        field = tuple(field.split('.'))
+
+    for key in field[:-1]:
+        document = document.get(key, None)
+        if not isinstance(document, dict):
+            return {}, field[-1]
+
+    return document, field[-1]
+
+
+def _split_paths(query):
+    """
+    Returns a copy of a query where dotted fields are split into tuples of keys
+    """
+    split = {}
+
+    for field, value in query.items():
+        if field in ('$and', '$or', '$nor') and isinstance(value, list):
+            value = [_split_paths(q) for q in value]
+        elif field == '$not' and isinstance(value, dict):
+            value = _split_paths(value)
+        elif isinstance(value, dict) and isinstance(value.get('$elemMatch'), dict):
+            value = dict(value)
+            value['$elemMatch'] = _split_paths(value['$elemMatch'])
+
+        if '.' in field and not field.startswith('$'):
+            field = tuple(field.split('.'))
+
+        split[field] = value
+
+    return split
+
+
+def _is_operator_query(query):
+    """
+    Returns True if a query consists only of operators, i.e. {'$gt': 5}, rather than
+    fields or logical operators
+    """
+    return all(k.startswith('$') and k not in ('$and', '$or', '$nor', '$not') for k in query)
+
+
+# BELOW ARE HELPERS FOR TRANSLATING QUERIES TO SQL
+_regex_cache = {}
+_regex_cache_size = 256
+
+
+def _compile_regex(pattern):
+    """
+    Returns a compiled regular expression, caching it so that repeated evaluation
+    of the same pattern (i.e. once per row by sqlite) does not recompile it. Invalid
+    patterns raise a MalformedQueryException
+    """
+    try:
+        return _regex_cache[pattern]
+    except KeyError:
+        pass
+
+    try:
+        compiled = re.compile(pattern)
+    except (re.error, TypeError):
+        raise MalformedQueryException("'$regex' pattern '%s' is invalid" % pattern)
+
+    if len(_regex_cache) >= _regex_cache_size:
+        _regex_cache.clear()
+
+    _regex_cache[pattern] = compiled
+    return compiled
+
+
+def _regexp(pattern, value):
+    """
+    The REGEXP function registered on sqlite connections, so that ``value REGEXP
+    pattern`` can be evaluated in SQL. Non-string values never match
+    """
+    if not isinstance(value, string_types):
+        return False
+
+    return _compile_regex(pattern).search(value) is not None
+
+
+def _regex_pattern(value, options=None):
+    """
+    Returns a regular expression string for a $regex query value, which may be a
+    string or a compiled regular expression, applying $options as inline flags
+    """
+    if hasattr(value, 'pattern'):
+        flags = ''.join(f for f, v in (('i', re.I), ('m', re.M), ('s', re.S), ('x', re.X))
+                        if value.flags & v)
+        options, value = (options or '') + flags, value.pattern
+
+    if not isinstance(value, string_types):
+        raise MalformedQueryException("'$regex' must be supplied a string")
+
+    if not options:
+        return value
+
+    if not isinstance(options, string_types) or set(options) - set('imsx'):
+        raise MalformedQueryException("'$options' may only contain the flags 'imsx'")
+
+    return '(?%s)%s' % (''.join(sorted(set(options))), value)
+
+
+def _regex_prefix(pattern):
+    """
+    Returns the literal prefix that every string matched by an anchored regular
+    expression must start with, or None. i.e. '^foo.*bar' has the prefix 'foo'.
+    Patterns with inline flags or alternations are never considered anchored
+    """
+    if not pattern.startswith('^') or '|' in pattern:
+        return None
+
+    match = re.match(r'[^.^$*+?{}\\\[\]|()]*', pattern[1:])
+    prefix = match.group(0)
+
+    # A quantifier applies to the last literal character, i.e. '^foo?'
+    if pattern[1 + len(prefix):][:1] in ('*', '?', '{'):
+        prefix = prefix[:-1]
+
+    return prefix or None
+
+
+def _prefix_upper(prefix):
+    """
+    Returns the smallest string that sorts after every string starting with ``prefix``
+    or None if there is no such string
+    """
+    while prefix:
+        last = ord(prefix[-1])
+        if last < sys.maxunicode:
+            # Surrogates cannot be encoded, and nothing sorts between them in UTF-8
+            following = 0xe000 if 0xd7ff <= last < 0xe000 else last + 1
+            return prefix[:-1] + unichr(following)
+        prefix = prefix[:-1]
+
+    return None
+
+
+def _json_path(field):
+    """
+    Returns a SQL string literal of the JSON path to a (possibly dotted) field
+    """
+    nodes = []
+    for node in field.split('.'):
+        if not re.match(r'^\w+$', node):
+            node = '"%s"' % node.replace('"', '\\"')
+        nodes.append(node)
+
+    return "'$.%s'" % '.'.join(nodes).replace("'", "''")
+
+
+def _field_path(field, root=None):
+    """
+    Returns a SQL expression for the JSON path to a (possibly dotted) field. If ``root``
+    is given, the path is relative to the array element being iterated by that
+    json_each alias, and a field of None is the element itself
+    """
+    if root is None:
+        return _json_path(field)
+    if field is None:
+        return '%s.fullkey' % root
+    return '%s.fullkey || %s' % (root, _json_path(field).replace("'$", "'", 1))
+
+
+def _field_expr(field, root=None):
+    """
+    Returns the SQL expression that evaluates to the value of a document field
+    """
+    if field == '_id' and root is None:
+        return 'id'
+    return 'json_extract(data, %s)' % _field_path(field, root)
+
+
+def _csv_expr(field):
+    """
+    Returns the SQL expression for the value of a field as written to a CSV file, where
+    embedded documents and arrays are written as JSON and booleans as True or False
+    """
+    path = _field_path(field)
+    if field == '_id':
+        return 'id'
+    return ("case json_type(data, {path}) when 'true' then 'True' when 'false' then 'False' "
+            "else json_extract(data, {path}) end").format(path=path)
+
+
+def _csv_value(value):
+    """
+    Returns the value of a field as written to a CSV file, matching ``_csv_expr``
+    """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, separators=(',', ':'))
+    return value
+
+
+def _csv_document(row):
+    """
+    Returns the JSON document for a row read from a CSV file, nesting dotted fields
+    """
+    document = {}
+
+    for field, value in row.items():
+        if field == '_id':
+            if value:
+                document['_id'] = int(value)
+            continue
+
+        keys = field.split('.')
+        section = document
+        for key in keys[:-1]:
+            section = section.setdefault(key, {})
+        section[keys[-1]] = value
+
+    return json.dumps(document)
+
+
+def _database_uri(database, uri, params):
+    """
+    Returns a sqlite URI for a database path, or a URI if ``uri`` is True, with some
+    query parameters added
+    """
+    if not uri:
+        database = 'file:%s' % pathname2url(database)
+    return '%s%s%s' % (database, '&' if '?' in database else '?', urlencode(params))
+
+
+@contextmanager
+def _open(target, mode, **kwargs):
+    """
+    A context manager for reading or writing a text file object or a path to a file,
+    which is opened as UTF-8 and closed if given
+    """
+    if hasattr(target, 'read') or hasattr(target, 'write'):
+        yield target
+        return
+
+    with io.open(target, mode, encoding='utf-8', **kwargs) as f:
+        yield f
+
+
+def _csv_reader(lines):
+    """
+    Returns the rows, as dicts, of CSV text lines. The csv module of python 2 only
+    reads bytes, so lines are encoded for it and the values it reads decoded
+    """
+    if sys.version_info[0] < 3:  # pragma: no cover Python < 3.0
+        def decode(value):
+            return value.decode('utf-8') if isinstance(value, bytes) else value
+
+        rows = csv.DictReader(line.encode('utf-8') for line in lines)
+        return (dict((decode(k), decode(v)) for k, v in row.items()) for row in rows)
+
+    return csv.DictReader(lines)
+
+
+def _csv_writer(output):
+    """
+    Returns a function that writes rows to a text file object as CSV. The csv module of
+    python 2 only writes bytes, so rows are written to a buffer and decoded from it
+    """
+    if sys.version_info[0] < 3:  # pragma: no cover Python < 3.0
+        buffer = io.BytesIO()
+        writer = csv.writer(buffer)
+
+        def writerows(rows):
+            writer.writerows([[v.encode('utf-8') if isinstance(v, text_type) else v for v in row]
+                              for row in rows])
+            output.write(buffer.getvalue().decode('utf-8'))
+            buffer.seek(0)
+            buffer.truncate()
+
+        return writerows
+
+    return csv.writer(output).writerows
+
+
+def _is_busy(error):
+    """
+    Returns True if a sqlite error means the database is locked by another connection
+    """
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+def _is_scalar(value):
+    """
+    Returns True if a value can be bound as a SQL parameter and compared to a
+    value extracted from a JSON document. sqlite integers are 64-bit, so larger
+    integers are left to be compared in Python
+    """
+    if isinstance(value, integer_types) and not isinstance(value, bool):
+        return -2 ** 63 <= value < 2 ** 63
+    return value is None or isinstance(value, (bool, float) + string_types)
+
+
+def _looks_like_json(value):
+    """
+    Returns True if a value is a string that could be equal to the text sqlite
+    extracts for a JSON object or array
+    """
+    return isinstance(value, string_types) and value[:1] in ('{', '[')
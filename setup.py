@@ -10,11 +10,8 @@ setup(name="nosqlite",
                    'Operating System :: OS Independent',
                    'Programming Language :: Python',
                    'Programming Language :: Python :: 2',
-                   'Programming Language :: Python :: 2.6',
                    'Programming Language :: Python :: 2.7',
                    'Programming Language :: Python :: 3',
-                   'Programming Language :: Python :: 3.3',
-                   'Programming Language :: Python :: 3.4',
                    'Topic :: Software Development :: Libraries :: Python Modules'],
       keywords='nosql sqlite nosqlite',
       author='Shaun Duncan',
@@ -22,5 +19,6 @@ setup(name="nosqlite",
       url='https://github.com/shaunduncan/nosqlite',
       license='MIT',
       py_modules=['nosqlite'],
+      python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*',
       include_package_data=True,
 )
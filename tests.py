@@ -1,13 +1,28 @@
 # coding: utf-8
+import io
+import json
 import re
 import sqlite3
+import sys
+import threading
+import time
 
+from array import array
 from mock import Mock, call, patch
-from pytest import fixture, mark, raises
+from pytest import fixture, importorskip, mark, raises
 
 import nosqlite
 
 
+CONTAINS = ("exists (select 1 from json_each(data, '$.%s') "
+            "where typeof(key) != 'text' and value %s)")
+IS_NULL = ("(json_type(data, '$.%s') is null or exists (select 1 from json_each(data, '$.%s') "
+           "where typeof(key) != 'text' and type = 'null'))")
+ARRAY_EQUALS = ("(json_extract(data, '$.%s') is json(?) or exists (select 1 from "
+                "json_each(data, '$.%s') where typeof(key) = 'integer' and "
+                "type = 'array' and value = json(?)))")
+
+
 @fixture(scope="module")
 def db(request):
     _db = sqlite3.connect(':memory:')
@@ -71,6 +86,429 @@ class TestConnection(object):
         assert foo not in conn.__dict__.values()
         assert isinstance(foo, nosqlite.Collection)
 
+    def test_create_collection(self):
+        conn = nosqlite.Connection(':memory:')
+        collection = conn.create_collection('foo')
+
+        assert collection.exists()
+        assert conn['foo'] is collection
+
+    def test_create_collection_capped(self):
+        conn = nosqlite.Connection(':memory:')
+        collection = conn.create_collection('foo', capped=True, max=2)
+
+        assert collection._object_exists('table', '[foo.capped]')
+
+    def test_start_reaper_raises_for_memory_database(self):
+        conn = nosqlite.Connection(':memory:')
+
+        with raises(AssertionError):
+            conn.start_reaper()
+
+    def test_reaper_expires_documents(self, tmpdir):
+        conn = nosqlite.Connection(str(tmpdir.join('test.db')))
+        conn.foo.create_index('expires', ttl_seconds=0)
+        conn.foo.insert({'expires': 0})
+        conn.foo.insert({'expires': 2 ** 40})
+
+        conn.start_reaper(interval=0.01)
+        assert conn._reaper.is_alive()
+
+        for _ in range(100):
+            if conn.foo.count() == 1:
+                break
+            time.sleep(0.01)
+
+        conn.close()
+        assert conn._reaper is None
+        assert [2 ** 40] == [d['expires'] for d in nosqlite.Connection(str(tmpdir.join('test.db'))).foo.find()]
+
+    def test_reaper_ignores_locked_database(self):
+        conn = nosqlite.Connection(':memory:')
+        conn.foo.create_index('expires', ttl_seconds=0)
+        conn.bar.create()
+        reaper = nosqlite._Reaper(conn, 1, 10)
+
+        with patch.object(nosqlite.Collection, 'expire') as expire:
+            expire.side_effect = sqlite3.OperationalError('database is locked')
+            reaper.reap(conn.db)
+            assert expire.call_count == 1
+
+    @mark.skipif(not hasattr(sqlite3.Connection, 'set_trace_callback'), reason='requires python 3.3')
+    def test_catalog_persists_collections_and_indexes(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        with nosqlite.Connection(path) as conn:
+            conn.foo.create_index('expires', ttl_seconds=10)
+            conn.foo.create_index('bar', multikey=True)
+            conn.foo.enable_oplog(size=5)
+
+        statements = []
+        conn = nosqlite.Connection(path)
+        conn.db.set_trace_callback(statements.append)
+
+        assert conn.foo.ttl == ('expires', 10)
+        assert conn.foo._indexes() == {'expires': 'value', 'bar': 'multikey'}
+        assert conn.catalog.collection('foo')['oplog'] == {'size': 5}
+        assert not [s for s in statements if 'sqlite_master' in s or s.lstrip().startswith('create')]
+
+    def test_catalog_bootstraps_from_existing_schema(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        db = sqlite3.connect(path)
+        collection = nosqlite.Collection(db, 'foo')
+        collection.create_index(['bar', 'baz'], sparse=True)
+        collection.create_index('qux', multikey=True)
+        db.commit()
+        db.close()
+
+        conn = nosqlite.Connection(path)
+        assert conn.catalog.collection('foo')['codec'] == 'json'
+        assert conn.catalog.indexes('foo')['bar,baz']['sparse']
+        assert conn.foo._indexes() == {'bar,baz': 'value', 'qux': 'multikey'}
+
+    def test_catalog_reloads_on_schema_change(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        conn = nosqlite.Connection(path)
+        conn.foo.insert({'a': 1})
+        other = nosqlite.Connection(path)
+        other.foo.create_index('a')
+
+        assert list(conn.catalog.indexes('foo')) == ['a']
+
+    def test_catalog_reloads_for_cached_collections(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        conn, other = nosqlite.Connection(path), nosqlite.Connection(path)
+        conn.foo.create_index('tags', multikey=True)
+        conn.foo.insert({'tags': ['x']})
+        assert other.foo.find({'tags': 'x'})[0]['tags'] == ['x']
+
+        conn.foo.drop_index('tags')
+        assert other.foo._indexes() == {}
+        assert other.foo.find({'tags': 'x'})[0]['tags'] == ['x']
+
+        conn.drop_collection('foo')
+        assert not other.foo.exists()
+
+    def test_drop_collection_removes_catalog_entries(self):
+        conn = nosqlite.Connection(':memory:')
+        conn.foo.create_index('a')
+        conn.drop_collection('foo')
+
+        assert conn.catalog.collection('foo') is None
+        assert conn.catalog.indexes('foo') == {}
+        assert conn.foo.exists()
+        assert conn.foo._indexes() == {}
+
+    def test_drop_collection_drops_multikey_indexes(self):
+        conn = nosqlite.Connection(':memory:')
+        conn.foo.create_index('tags', multikey=True)
+        conn.foo.insert({'tags': ['x']})
+        conn.drop_collection('foo')
+
+        conn.foo.create_index('tags', multikey=True)
+        conn.foo.insert({'tags': ['y']})
+        assert conn.foo.find({'tags': 'x'}) == []
+        assert conn.foo.find({'tags': 'y'})[0]['tags'] == ['y']
+
+    def test_drop_collection_drops_capped_size(self):
+        conn = nosqlite.Connection(':memory:')
+        conn.create_collection('foo', capped=True, size=100)
+        conn.foo.insert({'foo': 'x' * 90})
+        conn.drop_collection('foo')
+
+        conn.create_collection('foo', capped=True, size=100)
+        conn.foo.insert({'foo': 1})
+        conn.foo.insert({'foo': 2})
+        assert conn.foo.count() == 2
+
+    def test_drop_collection_drops_oplog(self):
+        conn = nosqlite.Connection(':memory:')
+        conn.foo.enable_oplog()
+        conn.foo.insert({'foo': 1})
+        conn.drop_collection('foo')
+
+        conn.foo.enable_oplog()
+        conn.foo.insert({'foo': 2})
+        changes = list(conn.foo.watch(since=0, timeout=0))
+        assert [c['document']['foo'] for c in changes] == [2]
+
+    @mark.skipif(not hasattr(sqlite3.Connection, 'set_trace_callback'), reason='requires python 3.3')
+    def test_rename_capped_and_oplog_from_catalog(self):
+        conn = nosqlite.Connection(':memory:')
+        conn.create_collection('foo', capped=True, max=2)
+        conn.foo.enable_oplog(size=10)
+        conn.foo.insert({'foo': 1})
+
+        statements = []
+        conn.db.set_trace_callback(statements.append)
+        collection = conn.foo
+        collection.rename('bar')
+        conn.db.set_trace_callback(None)
+        assert not [s for s in statements if 'sqlite_master' in s]
+
+        collection.insert({'foo': 2})
+        collection.insert({'foo': 3})
+        assert [2, 3] == [d['foo'] for d in collection.find()]
+        assert [1, 2, 3] == [c['_id'] for c in collection.watch(since=0, timeout=0) if c['op'] == 'insert']
+        assert conn.catalog.collection('bar')['oplog'] == {'size': 10}
+        names = [row[0] for row in conn.db.execute("select name from sqlite_master")]
+        assert not [n for n in names if n.startswith('foo')]
+
+    def test_rename_moves_indexes(self):
+        conn = nosqlite.Connection(':memory:')
+        collection = conn.foo
+        collection.create_index('a', ttl_seconds=5)
+        collection.rename('bar')
+
+        assert collection.ttl == ('a', 5)
+        assert conn.catalog.collection('foo') is None
+        assert list(conn.catalog.indexes('bar')) == ['a']
+        assert collection._object_exists('index', 'idx.bar{a}')
+        assert not collection._object_exists('index', 'idx.foo{a}')
+
+    def test_analyze_stats_are_kept_in_catalog(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        with nosqlite.Connection(path) as conn:
+            conn.foo.insert({'a': 1})
+            conn.foo.analyze()
+
+        conn = nosqlite.Connection(path)
+        assert conn.foo.stats()['fields'] == {'a': {'count': 1, 'distinct': 1}}
+
+    @mark.skipif(sys.version_info[0] < 3, reason='requires python 3')
+    def test_readonly(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        db = sqlite3.connect(path)
+        nosqlite.Collection(db, 'foo').insert({'a': 1})
+        db.commit()
+        db.close()
+
+        conn = nosqlite.Connection(path, readonly=True)
+        assert conn.readonly
+        assert conn.db.execute('pragma mmap_size').fetchone()[0] == nosqlite.READONLY_MMAP_SIZE
+        assert conn.foo.find({'a': 1})[0]['a'] == 1
+        assert not conn.bar.exists()
+
+        with raises(sqlite3.OperationalError):
+            conn.foo.insert({'a': 2})
+
+        with raises(AssertionError):
+            conn.start_reaper()
+
+        statement = "select count(1) from sqlite_master where name in ('bar', 'nosqlite_catalog')"
+        assert sqlite3.connect(path).execute(statement).fetchone()[0] == 0
+
+    @mark.skipif(sys.version_info[0] < 3, reason='requires python 3')
+    def test_immutable(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        with nosqlite.Connection(path) as conn:
+            conn.foo.insert({'a': 1})
+
+        conn = nosqlite.Connection(database=path, immutable=True, mmap=0)
+        assert conn.readonly
+        assert conn._connect_args[1]['database'] == 'file:%s?mode=ro&immutable=1' % path
+        assert conn.db.execute('pragma mmap_size').fetchone()[0] == 0
+        assert conn.foo.find_one()['a'] == 1
+
+    def test_readonly_uri(self):
+        assert 'file:a%20b.db?mode=ro' == nosqlite._database_uri('a b.db', False, [('mode', 'ro')])
+        assert 'file:a.db?cache=shared&mode=ro' == nosqlite._database_uri('file:a.db?cache=shared', True,
+                                                                         [('mode', 'ro')])
+
+    def test_readonly_raises_for_memory_database(self):
+        with raises(AssertionError):
+            nosqlite.Connection(':memory:', readonly=True)
+
+    @mark.skipif(sys.version_info < (3, 7), reason='requires python 3.7')
+    def test_backup(self, tmpdir):
+        conn = nosqlite.Connection(':memory:')
+        for i in range(100):
+            conn.foo.insert({'foo': 'x' * 1000})
+
+        progress = Mock()
+        path = str(tmpdir.join('backup.db'))
+        conn.backup(path, pages_per_step=10, progress=progress)
+
+        assert progress.call_count > 1
+        assert progress.call_args == call(0, progress.call_args[0][1])
+        assert nosqlite.Connection(path).foo.count() == 100
+
+    @mark.skipif(sys.version_info < (3, 7), reason='requires python 3.7')
+    def test_backup_to_connection(self):
+        conn = nosqlite.Connection(':memory:')
+        conn.foo.insert({'foo': 1})
+        dest = nosqlite.Connection(':memory:')
+
+        with patch('nosqlite.time') as mock_time:
+            conn.backup(dest, pages_per_step=1, throttle=0.5)
+            mock_time.sleep.assert_called_with(0.5)
+
+        assert dest.foo.find_one()['foo'] == 1
+
+    def test_compact(self, tmpdir):
+        conn = nosqlite.Connection(str(tmpdir.join('test.db')))
+        conn.db.execute('pragma auto_vacuum = incremental')
+        for i in range(100):
+            conn.foo.insert({'foo': 'x' * 1000})
+        conn.foo.clear()
+
+        free = conn.db.execute('pragma freelist_count').fetchone()[0]
+        pages = conn.db.execute('pragma page_count').fetchone()[0]
+        assert free > 10
+
+        assert conn.compact(max_pages=10, pages_per_step=3) == 10
+        assert conn.db.execute('pragma freelist_count').fetchone()[0] == free - 10
+
+        assert conn.compact() == free - 10
+        assert conn.db.execute('pragma freelist_count').fetchone()[0] == 0
+        assert conn.db.execute('pragma page_count').fetchone()[0] == pages - free
+
+    def test_compact_converts_database(self, tmpdir):
+        conn = nosqlite.Connection(str(tmpdir.join('test.db')))
+        for i in range(100):
+            conn.foo.insert({'foo': 'x' * 1000})
+        conn.foo.clear()
+
+        assert conn.compact() > 0
+        assert conn.db.execute('pragma auto_vacuum').fetchone()[0] == 2
+        assert conn.db.execute('pragma freelist_count').fetchone()[0] == 0
+
+    def test_start_writer_raises_for_memory_database(self):
+        conn = nosqlite.Connection(':memory:')
+
+        with raises(AssertionError):
+            conn.start_writer()
+
+    def test_writer(self, tmpdir):
+        conn = nosqlite.Connection(str(tmpdir.join('test.db')))
+        conn.foo.create()
+        writer = conn.start_writer()
+        assert conn.foo.writer is writer
+        assert conn.bar.writer is writer
+
+        document = conn.foo.insert({'a': 1})
+        assert document['_id'] == 1
+        document['a'] = 2
+        conn.foo.update(document)
+        conn.foo.insert({'a': 3})
+        conn.foo.remove({'_id': 2})
+
+        assert conn.foo.find() == [{'_id': 1, 'a': 2}]
+        assert writer.metrics()['writes'] == 4
+        assert writer.metrics()['queue_depth'] == 0
+        assert writer.metrics()['commit_latency']['max'] >= 0
+
+        conn.close()
+        assert conn.writer is None and conn.foo.writer is None
+        assert not writer.is_alive()
+
+        with raises(sqlite3.ProgrammingError):
+            writer.submit('insert into foo(data) values (?)', ('{}',))
+
+    def test_writer_group_commits_by_priority(self, tmpdir):
+        conn = nosqlite.Connection(str(tmpdir.join('test.db')))
+        conn.foo.create()
+        writer = nosqlite.WriteCoordinator(conn, max_batch=3)
+        conn.foo.writer = writer
+
+        def insert(a, priority):
+            with writer.priority(priority):
+                conn.foo.insert({'a': a})
+
+        threads = [threading.Thread(target=insert, args=(a, a)) for a in range(4)]
+        for thread in threads:
+            thread.start()
+        while writer.queue.qsize() < 4:
+            time.sleep(0.001)
+
+        batch = writer._next_batch()
+        assert [w.params for w in batch] == [('{"a": %d}' % a,) for a in (3, 2, 1)]
+        assert writer.metrics()['queue_depth'] == 1
+
+        writer._commit(conn.db, batch)
+        writer._commit(conn.db, writer._next_batch())
+        for thread in threads:
+            thread.join()
+
+        assert writer.metrics()['commits'] == 2
+        assert sorted(d['a'] for d in conn.foo.find()) == [0, 1, 2, 3]
+
+    def test_writer_fails_single_write(self, tmpdir):
+        conn = nosqlite.Connection(str(tmpdir.join('test.db')))
+        conn.foo.create()
+        writer = nosqlite.WriteCoordinator(conn)
+        good = nosqlite._Write('insert into foo(data) values (?)', ('{}',))
+        bad = nosqlite._Write('insert into bar(data) values (?)', ('{}',))
+
+        writer._commit(conn.db, [good, bad])
+
+        assert good.error is None and good.lastrowid == 1
+        assert isinstance(bad.error, sqlite3.OperationalError)
+        assert good.done.is_set() and bad.done.is_set()
+        assert conn.foo.count() == 1
+
+    def test_writer_retries_while_locked(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        conn = nosqlite.Connection(path)
+        conn.foo.create()
+        conn.start_writer(backoff=0.01)
+
+        other = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        other.execute('begin immediate')
+        timer = threading.Timer(0.1, other.execute, ('commit',))
+        timer.start()
+
+        assert conn.foo.insert({'a': 1})['_id'] == 1
+        assert conn.writer.metrics()['busy_retries'] > 0
+        timer.join()
+
+    def test_writer_gives_up_while_locked(self, tmpdir):
+        path = str(tmpdir.join('test.db'))
+        conn = nosqlite.Connection(path)
+        conn.foo.create()
+        writer = nosqlite.WriteCoordinator(conn, retries=2, backoff=0)
+        write = nosqlite._Write('insert into foo(data) values (?)', ('{}',))
+
+        other = sqlite3.connect(path, isolation_level=None)
+        other.execute('begin immediate')
+        writer._commit(sqlite3.connect(path, timeout=0, isolation_level=None), [write])
+
+        assert 'locked' in str(write.error)
+        assert writer.busy_retries == 2
+        assert writer.metrics()['commits'] == 0
+        assert writer.metrics()['writes'] == 0
+        assert writer.metrics()['commit_latency']['max'] is None
+
+    def test_cached_statements(self):
+        conn = nosqlite.Connection(':memory:', cached_statements=10)
+        assert conn.cached_statements == 10
+        assert conn.statements.size == 10
+
+    def test_statement_stats_count_hits(self):
+        conn = nosqlite.Connection(':memory:')
+        conn.foo.create()
+        conn.statements.reset()
+
+        for i in range(10):
+            conn.foo.insert({'a': i})
+
+        assert conn.statements.hits == 9
+        assert conn.statements.misses == 1
+
+    def test_statement_stats_evict_least_recently_used(self):
+        stats = nosqlite.StatementStats(2)
+        for sql in ('a', 'b', 'a', 'c', 'b', 'a'):
+            stats.record(sql)
+
+        assert (stats.hits, stats.misses) == (1, 5)
+
+    def test_rename_prepares_statements(self):
+        conn = nosqlite.Connection(':memory:')
+        collection = conn.foo
+        collection.rename('bar')
+
+        assert collection.insert({'a': 1})['_id'] == 1
+        assert collection._sql['insert'] == 'insert into bar(data) values (?)'
+
 
 class TestCollection(object):
 
@@ -106,6 +544,70 @@ class TestCollection(object):
         self.collection.create()
         assert self.collection.exists()
 
+    def test_create_capped_raises_without_limits(self):
+        with raises(AssertionError):
+            self.collection.create(capped=True)
+
+    def test_capped_max(self):
+        self.collection.create(capped=True, max=3)
+        for i in range(10):
+            self.collection.insert({'foo': i})
+
+        assert [7, 8, 9] == [d['foo'] for d in self.collection.find()]
+
+    def test_capped_max_counts_documents(self):
+        self.collection.create(capped=True, max=3)
+        for i in range(3):
+            self.collection.insert({'foo': i})
+        self.collection.remove(self.collection.find_one({'foo': 2}))
+        self.collection.insert({'foo': 3})
+
+        assert [0, 1, 3] == [d['foo'] for d in self.collection.find()]
+
+    def test_capped_size(self):
+        self.collection.create(capped=True, size=50)
+        for i in range(10):
+            self.collection.insert({'foo': i})  # 10 bytes each
+
+        assert [5, 6, 7, 8, 9] == [d['foo'] for d in self.collection.find()]
+
+        doc = self.collection.find_one({'foo': 9})
+        doc['foo'] = 'bar'
+        self.collection.update(doc)
+        self.collection.insert({'foo': 'b' * 50})
+
+        assert ['b' * 50] == [d['foo'] for d in self.collection.find()]
+        assert [(61,)] == self.collection.db.execute("select bytes from [foo.capped]").fetchall()
+
+    def test_capped_existing_collection(self):
+        self.collection.create()
+        for i in range(5):
+            self.collection.insert({'foo': i})
+
+        self.collection.create(capped=True, size=30)
+        self.collection.insert({'foo': 5})
+        assert [3, 4, 5] == [d['foo'] for d in self.collection.find()]
+
+    def test_tail(self):
+        self.collection.create()
+        self.collection.insert({'foo': 0})
+        documents = self.collection.tail({'foo': {'$gt': 1}}, timeout=0)
+
+        for i in range(1, 4):
+            self.collection.insert({'foo': i})
+
+        assert [2, 3] == [d['foo'] for d in documents]
+        assert [1, 2, 3] == [d['foo'] for d in self.collection.tail(since=1, timeout=0)]
+
+    def test_tail_applies_untranslated_query_in_python(self):
+        self.collection.create()
+        documents = self.collection.tail({'$not': {'foo': 1}}, timeout=0, batch=1)
+
+        for i in range(3):
+            self.collection.insert({'foo': i})
+
+        assert [0, 2] == [d['foo'] for d in documents]
+
     def test_insert_actually_updates(self):
         doc = {'_id': 1, 'foo': 'bar'}
 
@@ -171,10 +673,25 @@ class TestCollection(object):
     def test_find(self):
         query = {'foo': 'bar'}
         documents = [
-            (1, {'foo': 'bar', 'baz': 'qux'}),  # Will match
-            (2, {'foo': 'bar', 'bar': 'baz'}),  # Will match
-            (2, {'foo': 'baz', 'bar': 'baz'}),  # Will not match
-            (3, {'baz': 'qux'}),  # Will not match
+            {'foo': 'bar', 'baz': 'qux'},  # Will match
+            {'foo': 'bar', 'bar': 'baz'},  # Will match
+            {'foo': 'baz', 'bar': 'baz'},  # Will not match
+            {'baz': 'qux'},  # Will not match
+        ]
+
+        self.collection.create()
+        for document in documents:
+            self.collection.insert(document)
+
+        ret = self.collection.find(query)
+        assert len(ret) == 2
+
+    def test_find_applies_untranslated_query_in_python(self):
+        query = {'$not': {'foo': 'bar'}}
+        documents = [
+            (1, {'foo': 'bar', 'baz': 'qux'}),  # Will not match
+            (2, {'foo': 'baz', 'bar': 'baz'}),  # Will match
+            (3, {'baz': 'qux'}),  # Will match
         ]
 
         collection = nosqlite.Collection(Mock(), 'foo', create=False)
@@ -184,24 +701,86 @@ class TestCollection(object):
 
         ret = collection.find(query)
         assert len(ret) == 2
+        collection.db.execute.assert_called_with('select id, data from foo order by id', [])
 
     def test_find_honors_limit(self):
         query = {'foo': 'bar'}
         documents = [
-            (1, {'foo': 'bar', 'baz': 'qux'}),  # Will match
-            (2, {'foo': 'bar', 'bar': 'baz'}),  # Will match
-            (2, {'foo': 'baz', 'bar': 'baz'}),  # Will not match
-            (3, {'baz': 'qux'}),  # Will not match
+            {'foo': 'bar', 'baz': 'qux'},  # Will match
+            {'foo': 'bar', 'bar': 'baz'},  # Will match
+            {'foo': 'baz', 'bar': 'baz'},  # Will not match
+            {'baz': 'qux'},  # Will not match
         ]
 
-        collection = nosqlite.Collection(Mock(), 'foo', create=False)
-        collection.db.execute.return_value = collection.db
-        collection.db.fetchall.return_value = documents
-        collection._load = lambda id, data: data
+        self.collection.create()
+        for document in documents:
+            self.collection.insert(document)
 
-        ret = collection.find(query, limit=1)
+        ret = self.collection.find(query, limit=1)
         assert len(ret) == 1
 
+    @patch('nosqlite.numpy', None)
+    def test_find_columns(self):
+        self.collection.create()
+        for document in [{'foo': 1, 'bar': 'a', 'baz': 1.5, 'qux': {'quux': True}},
+                         {'foo': None, 'baz': 2},
+                         {'foo': 3, 'bar': 4}]:
+            self.collection.insert(document)
+
+        columns = self.collection.find_columns(fields=['_id', 'foo', 'bar', 'baz', 'qux.quux'], batch=2)
+        assert columns['_id'] == (array(nosqlite._INT_TYPECODE, [1, 2, 3]), array('B', [0, 0, 0]))
+        assert columns['foo'] == (array(nosqlite._INT_TYPECODE, [1, 0, 3]), array('B', [0, 1, 0]))
+        assert columns['bar'] == (['a', None, 4], array('B', [0, 1, 0]))
+        assert columns['baz'] == (array('d', [1.5, 2, 0]), array('B', [0, 0, 1]))
+        assert columns['qux.quux'] == (array(nosqlite._INT_TYPECODE, [1, 0, 0]), array('B', [0, 1, 1]))
+
+    @patch('nosqlite.numpy', None)
+    @mark.parametrize('batch', [1, 2, 3, 4])
+    def test_find_columns_do_not_depend_on_batch(self, batch):
+        self.collection.create()
+        for value in [1, None, 2.5, 'x']:
+            self.collection.insert({'foo': value})
+
+        values, mask = self.collection.find_columns(fields=['foo'], batch=batch)['foo']
+        assert [(type(v), v) for v in values] == [
+            (int, 1), (type(None), None), (float, 2.5), (type(u'x'), 'x'),
+        ]
+        assert mask == array('B', [0, 1, 0, 0])
+
+    @patch('nosqlite.numpy', None)
+    @mark.parametrize('query', [{'foo': {'$gt': 1}}, {'$nor': [{'foo': {'$lte': 1}}, {'foo': None}]}])
+    def test_find_columns_query(self, query):
+        self.collection.create()
+        for i in range(5):
+            self.collection.insert({'foo': i})
+
+        assert self.collection.find_columns(query, ['foo']) == {
+            'foo': (array(nosqlite._INT_TYPECODE, [2, 3, 4]), array('B', [0, 0, 0])),
+        }
+
+    @patch('nosqlite.numpy', None)
+    def test_find_columns_keep_insertion_order_with_indexes(self):
+        self.collection.create()
+        for i in range(5, 0, -1):
+            self.collection.insert({'foo': i})
+        self.collection.create_index('foo')
+
+        values, mask = self.collection.find_columns({'foo': {'$gt': 2}}, ['foo'])['foo']
+        assert values == array(nosqlite._INT_TYPECODE, [5, 4, 3])
+
+    def test_find_columns_numpy(self):
+        numpy = importorskip('numpy')
+        self.collection.create()
+        self.collection.insert({'foo': 1, 'bar': 'a'})
+        self.collection.insert({'foo': 2.5})
+
+        columns = self.collection.find_columns(fields=['foo', 'bar'])
+        assert columns['foo'][0].dtype == numpy.float64
+        assert list(columns['foo'][0]) == [1, 2.5]
+        assert columns['bar'][0].dtype == object
+        assert list(columns['bar'][0]) == ['a', None]
+        assert list(columns['bar'][1]) == [False, True]
+
     def test_apply_query_and_type(self):
         query = {'$and': [{'foo': 'bar'}, {'baz': 'qux'}]}
 
@@ -357,6 +936,477 @@ class TestCollection(object):
         with raises(nosqlite.MalformedQueryException):
             self.collection._apply_query(query, {'foo': 'bar'})
 
+    def test_apply_query_regex_operator(self):
+        query = {'foo': {'$regex': '^ba[rz]$'}}
+
+        assert self.collection._apply_query(query, {'foo': 'bar'})
+        assert not self.collection._apply_query(query, {'foo': 'Bar'})
+        assert not self.collection._apply_query(query, {'foo': 5})
+        assert not self.collection._apply_query(query, {'bar': 'bar'})
+
+    def test_apply_query_regex_operator_options(self):
+        query = {'foo': {'$regex': '^ba[rz]$', '$options': 'i'}}
+
+        assert self.collection._apply_query(query, {'foo': 'BAR'})
+        assert not self.collection._apply_query(query, {'foo': 'qux'})
+
+    def test_apply_query_regex_operator_compiled(self):
+        query = {'foo': {'$regex': re.compile('^ba[rz]$', re.I)}}
+
+        assert self.collection._apply_query(query, {'foo': 'BAZ'})
+        assert not self.collection._apply_query(query, {'foo': 'qux'})
+
+    @mark.parametrize('query', [
+        {'foo': {'$regex': '(unclosed'}},
+        {'foo': {'$regex': 5}},
+        {'foo': {'$regex': 'bar', '$options': 'q'}},
+    ])
+    def test_apply_query_regex_operator_raises(self, query):
+        with raises(nosqlite.MalformedQueryException):
+            self.collection._apply_query(query, {'foo': 'bar'})
+
+    def test_apply_query_startswith_operator(self):
+        query = {'foo': {'$startswith': 'ba'}}
+
+        assert self.collection._apply_query(query, {'foo': 'bar'})
+        assert not self.collection._apply_query(query, {'foo': 'qux'})
+        assert not self.collection._apply_query(query, {'foo': 5})
+
+    def test_apply_query_startswith_operator_raises(self):
+        query = {'foo': {'$startswith': 5}}
+
+        with raises(nosqlite.MalformedQueryException):
+            self.collection._apply_query(query, {'foo': 'bar'})
+
+    @mark.parametrize('query,where,params,exact', [
+        ({}, None, [], True),
+        ({'_id': 1}, 'id is ?', [1], True),
+        ({'foo': 'bar'}, CONTAINS % ('foo', '= ?'), ['bar'], True),
+        ({'foo': None}, IS_NULL % ('foo', 'foo'), [], True),
+        ({'foo': '{}'}, CONTAINS % ('foo', '= ?'), ['{}'], False),
+        ({'foo': ['a', 'b']}, ARRAY_EQUALS % ('foo', 'foo'), ['["a", "b"]', '["a", "b"]'], True),
+        ({'foo': [1, 2]}, None, [], False),
+        ({'foo': {'$ne': 1}}, 'not ' + CONTAINS % ('foo', '= ?'), [1], True),
+        ({'foo': {'$ne': '[]'}}, None, [], False),
+        ({'foo': {'$lt': 5}}, "json_extract(data, '$.foo') < ?", [5], True),
+        ({'foo': {'$gte': 5}},
+         "json_extract(data, '$.foo') >= ? and json_extract(data, '$.foo') < ?", [5, ''], True),
+        ({'foo': {'$gt': 'a'}},
+         "json_extract(data, '$.foo') > ? and json_extract(data, '$.foo') >= ?", ['a', ''], False),
+        ({'foo': {'$in': [1, None]}},
+         '(%s or %s)' % (CONTAINS % ('foo', 'in (?)'), IS_NULL % ('foo', 'foo')), [1], True),
+        ({'foo': {'$nin': [1, 2]}}, 'not ' + CONTAINS % ('foo', 'in (?, ?)'), [1, 2], True),
+        ({'foo': {'$all': [1, 2]}},
+         '%s and %s' % (CONTAINS % ('foo', '= ?'), CONTAINS % ('foo', '= ?')), [1, 2], True),
+        ({'foo': {'$size': 2}},
+         "(json_type(data, '$.foo') = 'array' and json_array_length(data, '$.foo') = ?)", [2], True),
+        ({'foo': {'$exists': False}}, "json_type(data, '$.foo') is null", [], True),
+        ({'foo': {'$mod': [2, 0]}}, None, [], False),
+        ({'foo bar': 1}, CONTAINS % ('"foo bar"', '= ?'), [1], True),
+        ({'foo.bar': 1}, CONTAINS % ('foo.bar', '= ?'), [1], True),
+        ({'foo"bar': 1}, None, [], False),
+        ({'foo.bar': {'$gt': 1}},
+         "json_extract(data, '$.foo.bar') > ? and json_extract(data, '$.foo.bar') < ?", [1, ''], True),
+        ({'$or': [{'foo': 1}, {'bar': 2}]},
+         '(%s or %s)' % (CONTAINS % ('foo', '= ?'), CONTAINS % ('bar', '= ?')), [1, 2], True),
+        ({'$or': [{'foo': 1}, {'$not': {'bar': 2}}]}, None, [], False),
+        ({'$and': [{'foo': 1}, {'$not': {'bar': 2}}]}, '(%s)' % CONTAINS % ('foo', '= ?'), [1], False),
+        ({'$nor': [{'foo': 1}]}, None, [], False),
+        ({'$or': []}, '0', [], True),
+        ({'$and': []}, None, [], True),
+    ])
+    def test_compile_query(self, query, where, params, exact):
+        assert (where, params, exact) == self.collection._compile_query(query)
+
+    def test_compile_query_regex_uses_prefix_range(self):
+        where, params, exact = self.collection._compile_query({'foo': {'$regex': '^bar.*z'}})
+
+        assert where == ("json_extract(data, '$.foo') >= ? and json_extract(data, '$.foo') < ? "
+                         "and json_type(data, '$.foo') = 'text' "
+                         "and json_extract(data, '$.foo') regexp ?")
+        assert params == ['bar', 'bas', '^bar.*z']
+        assert exact
+
+    @mark.parametrize('pattern,prefix', [
+        ('^bar', 'bar'),
+        ('^bar?', 'ba'),
+        ('^ba[rz]', 'ba'),
+        ('^bar|baz', None),
+        ('bar', None),
+        ('(?i)^bar', None),
+        ('^.*', None),
+    ])
+    def test_regex_prefix(self, pattern, prefix):
+        assert nosqlite._regex_prefix(pattern) == prefix
+
+    @mark.parametrize('query', [{'foo': {'$regex': u'^\ud7ff'}}, {'foo': {'$startswith': u'\ud7ff'}}])
+    def test_find_prefix_before_surrogates(self, query):
+        self.collection.create()
+        for value in [u'\ud7ff', u'\ud7ffa', u'\ue000']:
+            self.collection.insert({'foo': value})
+
+        assert [u'\ud7ff', u'\ud7ffa'] == [d['foo'] for d in self.collection.find(query)]
+
+    def test_find_key_with_quote(self):
+        self.collection.create()
+        self.collection.insert({'a"b': 2})
+        self.collection.insert({'a': 2})
+
+        assert [{'_id': 1, 'a"b': 2}] == self.collection.find({'a"b': 2})
+
+    def test_compile_query_raises(self):
+        with raises(nosqlite.MalformedQueryException):
+            self.collection._compile_query({'foo': {'$foo': 1}})
+
+        with raises(nosqlite.MalformedQueryException):
+            self.collection._compile_query({'foo': {'$regex': '(unclosed'}})
+
+    @mark.parametrize('query,expected', [
+        ({'foo': {'$regex': 'ar'}}, ['bar']),
+        ({'foo': {'$regex': '^b'}}, ['bar', 'baz']),
+        ({'foo': {'$regex': '^ba[^z]', '$options': 'i'}}, ['bar', 'BAR']),
+        ({'foo': {'$startswith': 'ba'}}, ['bar', 'baz']),
+        ({'foo': {'$gt': 1}}, [2]),
+    ])
+    def test_find_evaluates_operators_in_sql(self, query, expected):
+        self.collection.create()
+        for value in ['bar', 'baz', 'BAR', 1, 2, None, {'bar': 'baz'}]:
+            self.collection.insert({'foo': value})
+
+        assert expected == [d['foo'] for d in self.collection.find(query)]
+
+    def test_apply_query_matches_array_elements(self):
+        document = {'foo': ['bar', 'baz']}
+
+        assert self.collection._apply_query({'foo': 'bar'}, document)
+        assert self.collection._apply_query({'foo': {'$eq': 'baz'}}, document)
+        assert self.collection._apply_query({'foo': {'$in': ['baz', 'qux']}}, document)
+        assert self.collection._apply_query({'foo': ['bar', 'baz']}, document)
+        assert not self.collection._apply_query({'foo': 'qux'}, document)
+        assert not self.collection._apply_query({'foo': {'$ne': 'bar'}}, document)
+        assert not self.collection._apply_query({'foo': {'$nin': ['baz', 'qux']}}, document)
+
+    def test_apply_query_size_operator(self):
+        query = {'foo': {'$size': 2}}
+
+        assert self.collection._apply_query(query, {'foo': [1, 2]})
+        assert not self.collection._apply_query(query, {'foo': [1]})
+        assert not self.collection._apply_query(query, {'foo': 'ba'})
+
+    def test_apply_query_size_operator_raises(self):
+        query = {'foo': {'$size': '2'}}
+
+        with raises(nosqlite.MalformedQueryException):
+            self.collection._apply_query(query, {'foo': [1, 2]})
+
+    def test_apply_query_elem_match_operator(self):
+        query = {'foo': {'$elemMatch': {'$gte': 80, '$lt': 85}}}
+
+        assert self.collection._apply_query(query, {'foo': [70, 82]})
+        assert not self.collection._apply_query(query, {'foo': [70, 90]})
+        assert not self.collection._apply_query(query, {'foo': 82})
+
+    def test_apply_query_elem_match_documents(self):
+        query = {'foo': {'$elemMatch': {'bar': 'baz', 'qux': {'$gt': 5}}}}
+
+        assert self.collection._apply_query(query, {'foo': [{'bar': 'baz', 'qux': 10}]})
+        assert not self.collection._apply_query(query, {'foo': [{'bar': 'baz', 'qux': 1},
+                                                               {'bar': 'qux', 'qux': 10}]})
+        assert not self.collection._apply_query(query, {'foo': ['bar']})
+
+    def test_apply_query_elem_match_raises(self):
+        query = {'foo': {'$elemMatch': 5}}
+
+        with raises(nosqlite.MalformedQueryException):
+            self.collection._apply_query(query, {'foo': [5]})
+
+    @mark.parametrize('query,expected', [
+        ({'foo': 'bar'}, [1, 2]),
+        ({'foo': None}, [4, 5]),
+        ({'foo': {'$in': ['qux', 'baz']}}, [1, 4]),
+        ({'foo': {'$nin': ['bar']}}, [3, 4, 5]),
+        ({'foo': {'$all': ['bar', 'baz']}}, [1]),
+        ({'foo': ['bar', 'baz']}, [1]),
+        ({'foo': {'$size': 2}}, [1, 4]),
+        ({'foo': {'$elemMatch': {'$regex': '^q'}}}, [4]),
+        ({'bar': {'$elemMatch': {'baz': 'qux', 'n': {'$gt': 5}}}}, [2]),
+    ])
+    def test_find_matches_array_elements(self, query, expected):
+        self.collection.create()
+        for document in [
+            {'foo': ['bar', 'baz'], 'bar': [{'baz': 'qux', 'n': 1}, {'baz': 'foo', 'n': 10}]},
+            {'foo': 'bar', 'bar': [{'baz': 'qux', 'n': 10}]},
+            {'foo': {'bar': 'bar'}},
+            {'foo': ['qux', None]},
+            {'bar': 'baz'},
+        ]:
+            self.collection.insert(document)
+
+        assert expected == [d['_id'] for d in self.collection.find(query)]
+
+        self.collection.create_index('foo', multikey=True)
+        assert expected == [d['_id'] for d in self.collection.find(query)]
+
+    def test_create_index(self):
+        self.collection.create()
+        self.collection.create_index('foo')
+
+        assert self.collection._indexes() == {'foo': 'value'}
+
+        for query in ({'foo': 'bar'}, {'foo': {'$gt': 5}}):
+            where, params, exact = self.collection._compile_query(query)
+            plan = self.collection.db.execute(
+                'explain query plan select id from foo where %s' % where, params
+            ).fetchall()
+            assert all('SCAN foo' not in row[-1] for row in plan)
+            assert any('idx.foo{foo}' in row[-1] for row in plan)
+
+    def test_create_index_multikey(self):
+        self.collection.create()
+        doc = self.collection.insert({'foo': ['bar', 'baz', 'bar']})
+        self.collection.create_index('foo', multikey=True)
+        index = "select value from [foo{foo}] order by value"
+
+        assert self.collection._indexes() == {'foo': 'multikey'}
+        assert [('bar',), ('baz',)] == self.collection.db.execute(index).fetchall()
+
+        doc['foo'] = ['qux']
+        self.collection.update(doc)
+        self.collection.insert({'foo': 'bar'})
+        assert [('bar',), ('qux',)] == self.collection.db.execute(index).fetchall()
+
+        self.collection.remove(doc)
+        assert [('bar',)] == self.collection.db.execute(index).fetchall()
+
+    def test_create_index_multikey_raises_for_compound_key(self):
+        self.collection.create()
+
+        with raises(AssertionError):
+            self.collection.create_index(['foo', 'bar'], multikey=True)
+
+    def test_expire(self):
+        self.collection.create()
+        self.collection.create_index('expires', ttl_seconds=10)
+        for expires in [0, 5, 10, 15, 20, 'foo', None]:
+            self.collection.insert({'expires': expires})
+
+        assert 3 == self.collection.expire(batch=2, now=20)
+        assert [15, 20, 'foo', None] == [d['expires'] for d in self.collection.find()]
+
+    def test_expire_raises_without_ttl_index(self):
+        self.collection.create()
+        self.collection.create_index('expires')
+
+        with raises(AssertionError):
+            self.collection.expire()
+
+    def test_drop_index_removes_ttl(self):
+        self.collection.create()
+        self.collection.create_index('expires', ttl_seconds=10)
+        assert self.collection.ttl == ('expires', 10)
+
+        self.collection.drop_index('expires')
+        assert self.collection.ttl is None
+
+    def test_drop_indexes(self):
+        self.collection.create()
+        self.collection.create_index(['foo', 'bar'])
+        self.collection.create_index('baz', multikey=True)
+        assert self.collection._indexes() == {'foo,bar': 'value', 'baz': 'multikey'}
+
+        self.collection.drop_index('baz')
+        assert self.collection._indexes() == {'foo,bar': 'value'}
+        assert not self.collection._object_exists('table', '[foo{baz}]')
+
+        self.collection.drop_indexes()
+        assert self.collection._indexes() == {}
+
+    def test_stats(self):
+        self.collection.create()
+        self.collection.create_index('foo')
+        self.collection.create_index('bar', multikey=True)
+        self.collection.insert({'foo': 1, 'bar': [1, 2]})
+        self.collection.insert({'foo': 22, 'bar': [1, 2]})
+
+        stats = self.collection.stats()
+        assert (stats['count'], stats['size'], stats['max_size']) == (2, 51, 26)
+        assert stats['avg_size'] == 25.5
+        assert stats['pages'] >= 1 and stats['storage'] >= stats['free']
+        assert sorted(stats['indexes']) == ['bar', 'foo']
+        assert stats['indexes']['bar']['pages'] >= 2
+        assert stats['fields'] == {}
+
+    def test_stats_without_dbstat(self):
+        self.collection.create()
+        execute = self.collection._execute
+
+        def no_dbstat(sql, *args):
+            if 'dbstat' in sql:
+                raise sqlite3.OperationalError('no such table: dbstat')
+            return execute(sql, *args)
+
+        with patch.object(self.collection, '_execute', side_effect=no_dbstat):
+            stats = self.collection.stats()
+
+        assert stats['count'] == 0
+        assert stats['pages'] is None
+
+    def test_analyze_samples_field_cardinalities(self):
+        self.collection.create()
+        for i in range(10):
+            self.collection.insert({'foo': i % 2, 'bar': {'baz': i}, 'tags': [i, 'x'], 'qux': None})
+        self.collection.insert({'other': 1})
+
+        stats = self.collection.analyze(sample=100)
+        assert stats == {
+            'sampled': 11,
+            'fields': {
+                'foo': {'count': 10, 'distinct': 2},
+                'bar.baz': {'count': 10, 'distinct': 10},
+                'tags': {'count': 10, 'distinct': 11},
+                'qux': {'count': 10, 'distinct': 1},
+                'other': {'count': 1, 'distinct': 1},
+            },
+        }
+        assert self.collection.stats()['fields'] == stats['fields']
+        assert self.collection.analyze(sample=3)['sampled'] == 3
+
+    def test_analyze_demotes_unselective_multikey_index(self):
+        self.collection.create()
+        self.collection.create_index('tags', multikey=True)
+        for i in range(20):
+            self.collection.insert({'tags': [i % 2, 'x%d' % (i % 3)]})
+
+        assert self.collection._compile_query({'tags': 1})[0].startswith('id in')
+        self.collection.analyze()
+        assert self.collection._compile_query({'tags': 1})[0].startswith('+id in')
+        assert len(self.collection.find({'tags': 1})) == 10
+
+    @mark.parametrize('query,expected', [
+        ({'foo.bar': 'baz'}, True),
+        ({'foo.bar': 'qux'}, False),
+        ({'foo.qux': None}, True),
+        ({'foo.bar.baz': None}, True),
+        ({'foo.bar': {'$in': ['baz', 'qux']}}, True),
+        ({'foo.bar': {'$regex': '^b'}}, True),
+        ({'foo.num': {'$gt': 5, '$lt': 15}}, True),
+        ({'foo.num': {'$lt': 5}}, False),
+        ({'foo.bar': {'$exists': True}}, True),
+        ({'foo.qux': {'$exists': True}}, False),
+        ({'foo.qux.baz': {'$exists': False}}, True),
+        ({('foo', 'num'): {'$gte': 10}}, True),
+        ({'$or': [{'foo.bar': 'qux'}, {'foo.num': 10}]}, True),
+        ({'foo.list': {'$elemMatch': {'a.b': 1}}}, True),
+    ])
+    def test_apply_query_dotted_fields(self, query, expected):
+        document = {'foo': {'bar': 'baz', 'num': 10, 'list': [{'a': {'b': 1}}]}}
+        assert expected == self.collection._apply_query(query, document)
+
+    def test_split_paths(self):
+        query = {
+            'foo.bar': 1,
+            'baz': {'$elemMatch': {'qux.foo': {'$gt': 1}}},
+            '$or': [{'foo': 1}, {'bar.baz': 2}],
+            '$not': {'qux.bar': 3},
+        }
+
+        assert nosqlite._split_paths(query) == {
+            ('foo', 'bar'): 1,
+            'baz': {'$elemMatch': {('qux', 'foo'): {'$gt': 1}}},
+            '$or': [{'foo': 1}, {('bar', 'baz'): 2}],
+            '$not': {('qux', 'bar'): 3},
+        }
+
+    @mark.parametrize('query,expected', [
+        ({'foo.bar': 'baz'}, [1]),
+        ({'foo.num': {'$gte': 5}}, [1, 2]),
+        ({'foo.num': {'$in': [1, 5]}}, [2, 3]),
+        ({'foo.bar': {'$exists': False}}, [2, 3, 4]),
+        ({'$not': {'foo.num': {'$gt': 1}}}, [3, 4]),
+    ])
+    def test_find_dotted_fields(self, query, expected):
+        self.collection.create()
+        for document in [
+            {'foo': {'bar': 'baz', 'num': 10}},
+            {'foo': {'num': 5}},
+            {'foo': {'num': 1}},
+            {'foo': 'bar'},
+        ]:
+            self.collection.insert(document)
+
+        assert expected == [d['_id'] for d in self.collection.find(query)]
+
+    def test_create_index_dotted_field(self):
+        self.collection.create()
+        self.collection.create_index('foo.bar')
+        where, params, exact = self.collection._compile_query({'foo.bar': {'$gt': 5}})
+
+        plan = self.collection.db.execute(
+            'explain query plan select id from foo where %s' % where, params
+        ).fetchall()
+        assert 'idx.foo{foo.bar}' in plan[0][-1]
+
+    @mark.parametrize('index', [{'key': 'foo'}, {'key': ['bar', 'foo']},
+                                {'key': 'foo', 'ttl_seconds': 60}, {'key': 'foo', 'multikey': True}])
+    @mark.parametrize('query', [
+        {'foo': 1},
+        {'foo': 5},
+        {'foo': '[x'},
+        {'foo': {'$ne': 1}},
+        {'foo': {'$in': [5, None]}},
+        {'foo': {'$nin': [1]}},
+        {'foo': {'$all': [1, 5]}},
+        {'foo': {'$gt': 0}},
+    ])
+    def test_find_results_do_not_depend_on_indexes(self, index, query):
+        self.collection.create()
+        for document in [{'foo': 1}, {'bar': 2}, {'foo': [1, 5]}, {'foo': None}, {'foo': '[x'}]:
+            self.collection.insert(document)
+
+        expected = self.collection.find(query)
+        self.collection.create_index(**index)
+        assert self.collection.find(query) == expected
+
+    def test_find_keeps_insertion_order_with_indexes(self):
+        self.collection.create()
+        for i in range(10, 0, -1):
+            self.collection.insert({'foo': i})
+        self.collection.create_index('foo')
+
+        assert [d['_id'] for d in self.collection.find({'foo': {'$gt': 5}})] == [1, 2, 3, 4, 5]
+        assert self.collection.find_one({'foo': {'$gt': 5}})['_id'] == 1
+
+    @mark.parametrize('query,expected', [
+        ({'_id': {'$in': [1, 2]}}, [1, 2]),
+        ({'_id': {'$in': [1, None]}}, [1]),
+        ({'_id': {'$nin': [1]}}, [2, 3]),
+        ({'_id': {'$all': [2]}}, [2]),
+    ])
+    def test_find_id_operators(self, query, expected):
+        self.collection.create()
+        for i in range(3):
+            self.collection.insert({'foo': i})
+
+        assert expected == [d['_id'] for d in self.collection.find(query)]
+
+    @mark.parametrize('query', [
+        {'foo': 2 ** 70},
+        {'foo': {'$gt': 2 ** 64}},
+        {'foo': {'$in': [2 ** 70, -2 ** 70]}},
+    ])
+    def test_find_large_integers(self, query):
+        self.collection.create()
+        for value in [1, 2 ** 70]:
+            self.collection.insert({'foo': value})
+
+        assert [2 ** 70] == [d['foo'] for d in self.collection.find(query)]
+
+    def test_find_size_beyond_64_bits(self):
+        self.collection.create()
+        self.collection.insert({'foo': [1, 2]})
+
+        assert self.collection.find({'foo': {'$size': 2 ** 70}}) == []
+
     def test_get_operator_fn_improper_op(self):
         with raises(nosqlite.MalformedQueryException):
             self.collection._get_operator_fn('foo')
@@ -399,6 +1449,17 @@ class TestCollection(object):
 
         assert set(('bar', 'baz', 10)) == self.collection.distinct('foo')
 
+    def test_distinct_dotted_key(self):
+        docs = [
+            {'foo': {'bar': 'baz'}},
+            {'foo': {'bar': 10}},
+            {'foo': 'bar'},
+            {'bar': 'foo'}
+        ]
+        self.collection.find = lambda: docs
+
+        assert set(('baz', 10)) == self.collection.distinct('foo.bar')
+
     def test_rename_raises_for_collision(self):
         nosqlite.Collection(self.db, 'bar')  # Create a collision point
         self.collection.create()
@@ -416,6 +1477,217 @@ class TestCollection(object):
 
         assert not nosqlite.Collection(self.db, 'foo', create=False).exists()
 
+    def test_rename_moves_capped_and_oplog(self):
+        self.collection.create(capped=True, max=2)
+        self.collection.enable_oplog()
+        self.collection.insert({'foo': 1})
+
+        self.collection.rename('bar')
+        self.collection.insert({'foo': 2})
+        self.collection.insert({'foo': 3})
+
+        assert [2, 3] == [d['foo'] for d in self.collection.find()]
+        assert [1, 2, 3] == [c['_id'] for c in self.collection.watch(since=0, timeout=0)
+                             if c['op'] == 'insert']
+        names = [row[0] for row in self.db.execute("select name from sqlite_master")]
+        assert not [n for n in names if n.startswith('foo')]
+
+        self.collection.disable_oplog()
+        names = [row[0] for row in self.db.execute("select name from sqlite_master")]
+        assert not [n for n in names if n.startswith('bar.oplog')]
+
+    def test_watch(self):
+        self.collection.create()
+        self.collection.enable_oplog()
+        changes = self.collection.watch(timeout=0)
+
+        doc = self.collection.insert({'foo': 'bar'})
+        doc['foo'] = 'baz'
+        self.collection.update(doc)
+        self.collection.remove(doc)
+
+        assert list(changes) == [
+            {'seq': 1, 'op': 'insert', '_id': 1, 'document': {'_id': 1, 'foo': 'bar'}},
+            {'seq': 2, 'op': 'update', '_id': 1, 'document': {'_id': 1, 'foo': 'baz'}},
+            {'seq': 3, 'op': 'remove', '_id': 1, 'document': None},
+        ]
+
+    def test_watch_since(self):
+        self.collection.create()
+        self.collection.enable_oplog()
+        for i in range(5):
+            self.collection.insert({'foo': i})
+
+        assert [4, 5] == [c['seq'] for c in self.collection.watch(since=3, timeout=0, batch=1)]
+        assert [] == list(self.collection.watch(timeout=0))
+
+    def test_watch_polls_until_timeout(self):
+        self.collection.create()
+        self.collection.enable_oplog()
+
+        with patch('nosqlite.time') as mock_time:
+            mock_time.time.side_effect = [0, 0.5, 1.5]
+            assert [] == list(self.collection.watch(interval=0.5, timeout=1))
+            mock_time.sleep.assert_called_once_with(0.5)
+
+    def test_watch_raises_without_oplog(self):
+        self.collection.create()
+
+        with raises(AssertionError):
+            self.collection.watch()
+
+    def test_oplog_size(self):
+        self.collection.create()
+        self.collection.enable_oplog(size=2)
+        for i in range(5):
+            self.collection.insert({'foo': i})
+
+        assert [4, 5] == [c['seq'] for c in self.collection.watch(since=0, timeout=0)]
+
+    def test_trim_oplog(self):
+        self.collection.create()
+        self.collection.enable_oplog()
+        for i in range(5):
+            self.collection.insert({'foo': i})
+
+        self.collection.trim_oplog(3)
+        assert [4, 5] == [c['seq'] for c in self.collection.watch(since=0, timeout=0)]
+
+    def test_disable_oplog(self):
+        self.collection.create()
+        self.collection.enable_oplog()
+        self.collection.disable_oplog()
+        self.collection.insert({'foo': 'bar'})
+
+        assert not self.collection._object_exists('table', '[foo.oplog]')
+
+    def test_import_jsonl(self):
+        self.collection.create()
+        self.collection.insert({'foo': 'bar'})
+        progress = Mock()
+        source = io.StringIO(u'{"foo": "baz"}\n\n{"_id": 1, "foo": "qux"}\n{"_id": 5}\n')
+
+        assert 3 == self.collection.import_jsonl(source, batch=2, progress=progress)
+        assert progress.call_args_list == [call(2), call(3)]
+        assert [{'_id': 1, 'foo': 'qux'}, {'_id': 2, 'foo': 'baz'}, {'_id': 5}] == self.collection.find()
+
+    def test_import_jsonl_path(self, tmpdir):
+        path = tmpdir.join('foo.jsonl')
+        path.write('{"foo": "bar"}\n')
+        self.collection.create()
+
+        assert 1 == self.collection.import_jsonl(str(path))
+        assert [{'_id': 1, 'foo': 'bar'}] == self.collection.find()
+
+    def test_import_jsonl_rolls_back_malformed_batch(self):
+        self.collection.create()
+        source = io.StringIO(u'{"foo": 1}\n{"foo": 2}\n{"foo": 3}\n{foo\n')
+
+        with raises(sqlite3.OperationalError):
+            self.collection.import_jsonl(source, batch=2)
+
+        assert [1, 2] == [d['foo'] for d in self.collection.find()]
+
+    @mark.parametrize('line', [u'[1, 2]', u'"s"', u'5', u'null'])
+    def test_import_jsonl_rejects_non_objects(self, line):
+        self.collection.create()
+        source = io.StringIO(u'{"foo": 1}\n{"foo": 2}\n{"foo": 3}\n%s\n' % line)
+
+        with raises(nosqlite.MalformedQueryException):
+            self.collection.import_jsonl(source, batch=2)
+
+        assert [1, 2] == [d['foo'] for d in self.collection.find()]
+
+    def test_import_jsonl_defer_indexes(self):
+        self.collection.create()
+        self.collection.create_index('foo', sparse=True)
+        self.collection.create_index('bar', multikey=True)
+        source = io.StringIO(u'{"foo": 1, "bar": ["a", "b"]}\n{"foo": 2, "bar": "b"}\n')
+
+        with patch.object(self.collection, 'drop_index', wraps=self.collection.drop_index) as drop:
+            self.collection.import_jsonl(source, defer_indexes=True)
+            assert drop.call_count == 2
+
+        assert self.collection._indexes() == {'foo': 'value', 'bar': 'multikey'}
+        assert [1, 2] == [d['foo'] for d in self.collection.find({'bar': 'b'})]
+        assert self.collection.db.execute(
+            "select sql from sqlite_master where name = 'idx.foo{foo}'"
+        ).fetchone()[0].endswith('is not null')
+
+    def test_import_csv(self):
+        self.collection.create()
+        source = io.StringIO(u'_id,foo,bar.baz\n,a,b\n5,c,\n')
+
+        assert 2 == self.collection.import_csv(source)
+        assert [
+            {'_id': 1, 'foo': 'a', 'bar': {'baz': 'b'}},
+            {'_id': 5, 'foo': 'c', 'bar': {'baz': ''}},
+        ] == self.collection.find()
+
+    def test_export_jsonl(self):
+        self.collection.create()
+        for document in [{'foo': 1}, {}, {'foo': {'bar': [1, 2]}}]:
+            self.collection.insert(document)
+        progress = Mock()
+        dest = io.StringIO()
+
+        assert 3 == self.collection.export_jsonl(dest, batch=2, progress=progress)
+        assert progress.call_args_list == [call(2), call(3)]
+        assert [json.loads(line) for line in dest.getvalue().splitlines()] == self.collection.find()
+
+    def test_export_jsonl_writes_stored_data(self):
+        self.collection.create()
+        self.collection.db.execute('insert into foo(data) values (\'{"foo":1}\')')
+        dest = io.StringIO()
+
+        with patch.object(self.collection, '_load') as load:
+            self.collection.export_jsonl(dest, {'foo': 1})
+            assert not load.called
+
+        assert dest.getvalue() == '{"_id": 1, "foo":1}\n'
+
+    def test_export_jsonl_fields(self):
+        self.collection.create()
+        for document in [{'foo': 1, 'bar': {'baz': 2}}, {'foo': 2}]:
+            self.collection.insert(document)
+        dest = io.StringIO()
+
+        assert 1 == self.collection.export_jsonl(dest, {'$not': {'foo': 2}}, fields=['bar.baz', 'qux'])
+        assert json.loads(dest.getvalue()) == {'_id': 1, 'bar.baz': 2}
+
+    @mark.parametrize('query', [{'foo': {'$ne': 2}}, {'$nor': [{'foo': 2}]}])
+    def test_export_csv(self, query):
+        self.collection.create()
+        for document in [{'foo': 1, 'bar': {'baz': [1, 2]}}, {'foo': 'a,b', 'bar': True}, {'foo': 2}]:
+            self.collection.insert(document)
+        dest = io.StringIO()
+
+        assert 2 == self.collection.export_csv(dest, ['_id', 'foo', 'bar', 'bar.baz'], query=query)
+        assert dest.getvalue().splitlines() == [
+            '_id,foo,bar,bar.baz',
+            '1,1,"{""baz"":[1,2]}","[1,2]"',
+            '2,"a,b",True,',
+        ]
+
+    @mark.parametrize('export,load', [
+        ('export_jsonl', 'import_jsonl'),
+        ('export_csv', 'import_csv'),
+    ])
+    @mark.parametrize('query', [None, {'$not': {'foo': 'bar'}}])
+    def test_export_and_import_paths_as_utf8(self, tmpdir, export, load, query):
+        path = str(tmpdir.join('foo'))
+        self.collection.create()
+        self.collection.insert({'foo': u'caf\xe9 \u2603'})
+
+        if export == 'export_csv':
+            getattr(self.collection, export)(path, ['_id', 'foo'], query=query)
+        else:
+            getattr(self.collection, export)(path, query)
+
+        other = nosqlite.Collection(self.db, 'bar')
+        assert 1 == getattr(other, load)(path)
+        assert other.find()[0]['foo'] == u'caf\xe9 \u2603'
+
 
 class TestFindOne(object):
 
@@ -425,3 +1697,78 @@ class TestFindOne(object):
     def test_returns_None_if_document_is_not_found(self, collection):
         collection.create()
         assert collection.find_one({}) is None
+
+
+class TestShardedConnection(object):
+
+    @fixture
+    def conn(self, tmpdir, request):
+        conn = nosqlite.ShardedConnection([str(tmpdir.join('%d.db' % i)) for i in range(3)])
+        request.addfinalizer(conn.close)
+        return conn
+
+    def test_getitem_returns_cached_collection(self, conn):
+        assert isinstance(conn['foo'], nosqlite.ShardedCollection)
+        assert conn.foo is conn['foo']
+
+    def test_insert_strides_ids_across_shards(self, conn):
+        ids = [conn.foo.insert({'foo': i})['_id'] for i in range(6)]
+
+        assert ids == [1, 2, 3, 4, 5, 6]
+        assert [[1, 4], [2, 5], [3, 6]] == [[d['_id'] for d in s.foo.find()] for s in conn.shards]
+
+    def test_insert_by_shard_key(self, tmpdir):
+        conn = nosqlite.ShardedConnection([str(tmpdir.join('%d.db' % i)) for i in range(3)],
+                                          shard_key='user')
+        for i in range(9):
+            conn.foo.insert({'user': i % 3})
+
+        for user in range(3):
+            shards = conn.foo._shards_for_query({'user': user})
+            assert len(shards) == 1
+            assert 3 == conn.shards[shards[0]].foo.count({'user': user})
+            assert 3 == conn.foo.count({'user': {'$eq': user}})
+
+        assert len(set(conn.foo._shards_for_query({'user': user})[0] for user in range(3))) > 1
+        assert 9 == len(conn.foo.find())
+        assert 9 == conn.foo.count()
+        assert 6 == conn.foo.count({'user': {'$gt': 0}})
+        conn.close()
+
+    def test_update_and_remove_route_by_id(self, conn):
+        docs = [conn.foo.insert({'foo': i}) for i in range(6)]
+        docs[4]['foo'] = 'bar'
+        conn.foo.update(docs[4])
+        conn.foo.remove(docs[2])
+
+        assert [0, 1, 3, 'bar', 5] == [d['foo'] for d in conn.foo.find()]
+        assert [1, 'bar'] == [d['foo'] for d in conn.shards[1].foo.find()]
+
+    def test_find_gathers_shards(self, conn):
+        for i in range(10):
+            conn.foo.insert({'foo': i})
+
+        assert [5, 6, 7, 8, 9] == [d['foo'] for d in conn.foo.find({'foo': {'$gte': 5}})]
+        assert [0, 1] == [d['foo'] for d in conn.foo.find(limit=2)]
+        assert {'_id': 5, 'foo': 4} == conn.foo.find_one({'_id': 5})
+        assert [1] == conn.foo._shards_for_query({'_id': 5})
+        assert 4 == conn.foo.count({'foo': {'$lt': 4}})
+        assert set(range(10)) == conn.foo.distinct('foo')
+
+    def test_find_and_modify(self, conn):
+        for i in range(4):
+            conn.foo.insert({'foo': i})
+
+        conn.foo.find_and_modify({'foo': {'$gt': 1}}, {'bar': True})
+        assert [2, 3] == [d['foo'] for d in conn.foo.find({'bar': True})]
+
+    def test_create_index_on_every_shard(self, conn):
+        conn.foo.create_index('foo')
+
+        assert all(s.foo._indexes() == {'foo': 'value'} for s in conn.shards)
+
+    def test_drop_collection(self, conn):
+        conn.foo.insert({'foo': 'bar'})
+        conn.drop_collection('foo')
+
+        assert not any(nosqlite.Collection(s.db, 'foo', create=False).exists() for s in conn.shards)